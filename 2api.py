@@ -1,17 +1,49 @@
 import requests
+from requests.adapters import HTTPAdapter
+import asyncio
 import json
+import atexit
+import _thread
 import base64
-from typing import Dict, Optional
-from flask import Flask, request, Response, stream_with_context
+import functools
+import hashlib
+import importlib.util
+import logging
+import logging.handlers
+import math
+import queue
+import random
+import re
+import selectors
+import signal
+import socket
+import sqlite3
+import sys
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 import os
+import threading
 import time
-from datetime import datetime, timedelta
 
-# Initialize Flask app
-app = Flask(__name__)
+# Optional: only required by the asyncio (ASGI) serving mode, so it is imported on first use
+httpx = None
+
+
+def _import_httpx():
+    global httpx
+    if httpx is None:
+        import httpx as module
+        httpx = module
+    return httpx
+
+
+logger = logging.getLogger("ondemand_proxy")
 
 # Load configuration from config.json if it exists, otherwise use environment variables
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+config = {}
 if os.path.exists(CONFIG_FILE):
     with open(CONFIG_FILE, 'r') as f:
         config = json.load(f)
@@ -23,16 +55,512 @@ else:
         try:
             ACCOUNTS = json.loads(accounts_env).get('accounts', [])
         except json.JSONDecodeError:
-            print("Error decoding ONDEMAND_ACCOUNTS environment variable. Using empty accounts list.")
+            logger.error("Error decoding ONDEMAND_ACCOUNTS environment variable. Using empty accounts list.")
+
+
+def parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ("1", "true", "yes", "on"):
+        return True
+    if str(value).strip().lower() in ("0", "false", "no", "off"):
+        return False
+    raise ValueError(value)
+
+
+def get_setting(name: str, default, cast=str):
+    """Read a tuning option from config.json (lowercase key) or the environment (uppercase name)."""
+    value = config.get(name.lower())
+    if value is None:
+        value = os.getenv(name.upper())
+    if value is None or value == "":
+        return default
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        logger.warning("Invalid value for %s: %r. Using default %r.", name, value, default)
+        return default
+
+
+# ---------------------------------------------------------------------------
+# Logging
+# ---------------------------------------------------------------------------
+# Records are handed to a bounded queue and formatted/written by a background listener
+# thread, so request threads never block on stdout. Request payloads are only logged at
+# DEBUG level, for a LOG_PAYLOAD_SAMPLE_RATE fraction of requests, capped at
+# LOG_PAYLOAD_MAX_CHARS. LOG_FORMAT is "text" or "json" (one JSON object per line).
+LOG_LEVEL = get_setting("log_level", "INFO").upper()
+LOG_FORMAT = get_setting("log_format", "text").lower()
+LOG_PAYLOAD_MAX_CHARS = get_setting("log_payload_max_chars", 2000, int)
+LOG_PAYLOAD_SAMPLE_RATE = get_setting("log_payload_sample_rate", 1.0, float)
+LOG_QUEUE_SIZE = get_setting("log_queue_size", 10000, int)
+
+
+def redact(secret: str) -> str:
+    """Render a token or other credential without revealing it."""
+    if not secret:
+        return "<empty>"
+    return f"{secret[:4]}...({len(secret)} chars)"
+
+
+class Excerpt:
+    """Lazily JSON-serialized, size-capped view of a payload; only rendered if the record is emitted."""
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit: int = LOG_PAYLOAD_MAX_CHARS):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = self.value if isinstance(self.value, str) else json.dumps(self.value, ensure_ascii=False, default=str)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}...({len(text) - self.limit} more chars)"
+
+
+def sample_payload() -> bool:
+    """Whether this request's payload should be logged (DEBUG enabled and sampled in)."""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_PAYLOAD_SAMPLE_RATE
+
+
+class StructuredFormatter(logging.Formatter):
+    """Text or JSON-lines output; structured fields are passed as ``extra={"fields": {...}}``."""
+
+    def __init__(self, json_lines: bool):
+        super().__init__("%(asctime)s %(levelname)s [%(threadName)s] %(message)s")
+        self.json_lines = json_lines
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None) or {}
+        if not self.json_lines:
+            line = super().format(record)
+            if fields:
+                line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+            return line
+        entry = {"time": self.formatTime(record), "level": record.levelname, "thread": record.threadName,
+                 "message": record.getMessage()}
+        entry.update((key, str(value)) for key, value in fields.items())
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records unformatted and drops them when the queue is full instead of blocking."""
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _BackgroundQueueHandler.dropped += 1
+
+
+# Writes the queued records of this process; replaced in forked children
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _stop_log_listener():
+    # Flush what is still queued on exit
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
+def configure_logging():
+    global _log_listener
+    if logger.handlers:
+        return
+    output = logging.StreamHandler()
+    output.setFormatter(StructuredFormatter(json_lines=LOG_FORMAT == "json"))
+    handler = _BackgroundQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    _log_listener = logging.handlers.QueueListener(handler.queue, output)
+    _log_listener.start()
+    atexit.register(_stop_log_listener)
+    logger.addHandler(handler)
+
+    def restart_in_child():
+        # The writer thread does not survive a fork (gunicorn workers forked after preload), so
+        # the child gets a queue and listener of its own
+        global _log_listener
+        handler.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _log_listener = logging.handlers.QueueListener(handler.queue, output)
+        _log_listener.start()
+        _BackgroundQueueHandler.dropped = 0
+
+    os.register_at_fork(after_in_child=restart_in_child)
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+
+
+
+# Upstream HTTP connection pool tuning (per account client)
+UPSTREAM_POOL_SIZE = get_setting("upstream_pool_size", 20, int)
+UPSTREAM_CONNECT_TIMEOUT = get_setting("upstream_connect_timeout", 5.0, float)
+UPSTREAM_READ_TIMEOUT = get_setting("upstream_read_timeout", 120.0, float)
+
+# Upstream endpoints; overridable to point the proxy at a local stand-in (see bench/mock_upstream.py)
+ONDEMAND_BASE_URL = get_setting("ondemand_base_url", "https://gateway.on-demand.io/v1")
+ONDEMAND_CHAT_BASE_URL = get_setting("ondemand_chat_base_url", "https://api.on-demand.io/chat/v1/client")
+
+# Model registry: public model ids -> on-demand.io endpoint ids and per-model defaults. Read from
+# the "models" key of MODELS_FILE (config.json by default) or the MODELS environment variable
+# (JSON), falling back to the built-in list. MODELS_FILE is re-read when it changes, checked at
+# most every MODELS_RELOAD_INTERVAL seconds.
+MODELS_FILE = get_setting("models_file", CONFIG_FILE)
+MODELS_RELOAD_INTERVAL = get_setting("models_reload_interval", 5.0, float)
+
+# Conversation forwarding. "latest" sends only the newest user message and relies on the upstream
+# session for context; "full" sends the whole messages array on a fresh upstream session, trimmed
+# to PROMPT_MAX_TOKENS (approximate, 0 = no limit) by dropping the oldest turns. The rendered prompt
+# is cached per client (PROMPT_CACHE_MAX_ENTRIES clients) so each request only renders and appends
+# its new turns.
+CONVERSATION_MODE = get_setting("conversation_mode", "latest").lower()
+PROMPT_MAX_TOKENS = get_setting("prompt_max_tokens", 0, int)
+PROMPT_CACHE_MAX_ENTRIES = get_setting("prompt_cache_max_entries", 1000, int)
+
+# Upstream generation options sent with every query. A model's registry "defaults" (e.g.
+# {"reasoning_effort": "low", "debug_mode": "off", "max_tokens": 256}) override these, and the
+# request's own OpenAI parameters (max_tokens, temperature, top_p, stop, penalties,
+# reasoning_effort) override the model defaults. debug_mode can only be set in the defaults.
+UPSTREAM_REASONING_MODE = get_setting("upstream_reasoning_mode", "high")
+UPSTREAM_DEBUG_MODE = get_setting("upstream_debug_mode", "on")
+
+# Streaming translation: upstream read size, and optional coalescing of tiny deltas into one
+# chunk until STREAM_COALESCE_BYTES are buffered or STREAM_COALESCE_MS have passed. With both
+# at 0 every upstream delta is sent as-is; with only the byte limit set, deltas are merged
+# within one upstream read. The time window is checked when upstream data arrives.
+STREAM_READ_CHUNK_SIZE = get_setting("stream_read_chunk_size", 4096, int)
+STREAM_COALESCE_BYTES = get_setting("stream_coalesce_bytes", 0, int)
+STREAM_COALESCE_MS = get_setting("stream_coalesce_ms", 0.0, float)
+
+# Optional cache for identical non-streaming completions (model + endpoint + messages + options).
+# Only answers that depend on the request alone are cached: the whole conversation is forwarded
+# (full mode) or it is a single user turn, which then starts a new upstream session, and the
+# temperature is not above 0. Memory is bounded by RESPONSE_CACHE_MAX_BYTES; RESPONSE_CACHE_DIR
+# adds an on-disk tier, swept every RESPONSE_CACHE_SWEEP_INTERVAL seconds of expired entries and
+# of the oldest ones beyond RESPONSE_CACHE_DIR_MAX_BYTES (0 = no size limit). Clients can skip it
+# per request with "Cache-Control: no-cache" (refresh) or "no-store" (bypass).
+RESPONSE_CACHE_ENABLED = get_setting("response_cache_enabled", False, parse_bool)
+RESPONSE_CACHE_MAX_BYTES = get_setting("response_cache_max_bytes", 64 * 1024 * 1024, int)
+RESPONSE_CACHE_TTL_SECONDS = get_setting("response_cache_ttl_seconds", 3600.0, float)
+RESPONSE_CACHE_DIR = get_setting("response_cache_dir", "")
+RESPONSE_CACHE_DIR_MAX_BYTES = get_setting("response_cache_dir_max_bytes", 1024 * 1024 * 1024, int)
+RESPONSE_CACHE_SWEEP_INTERVAL = get_setting("response_cache_sweep_interval", 300.0, float)
+
+# Account health: consecutive failures before an account is benched, and for how long
+ACCOUNT_FAILURE_THRESHOLD = get_setting("account_failure_threshold", 3, int)
+ACCOUNT_COOLDOWN_SECONDS = get_setting("account_cooldown_seconds", 60.0, float)
+
+# Retry/failover before the client has received any bytes. Failed attempts are retried on
+# another account up to RETRY_MAX_ATTEMPTS times with exponential backoff and full jitter,
+# as long as the retry starts within REQUEST_DEADLINE_SECONDS of the request; no streaming
+# attempt waits for response headers past that deadline either (a non-streaming response only
+# starts once the whole answer is ready, so it keeps UPSTREAM_READ_TIMEOUT). With
+# HEDGE_AFTER_SECONDS > 0 a streaming query that has not responded by then is raced against a
+# second attempt on another account (only when an admission slot is free).
+RETRY_MAX_ATTEMPTS = get_setting("retry_max_attempts", 3, int)
+RETRY_BACKOFF_BASE_SECONDS = get_setting("retry_backoff_base_seconds", 0.2, float)
+RETRY_BACKOFF_MAX_SECONDS = get_setting("retry_backoff_max_seconds", 2.0, float)
+REQUEST_DEADLINE_SECONDS = get_setting("request_deadline_seconds", 30.0, float)
+HEDGE_AFTER_SECONDS = get_setting("hedge_after_seconds", 0.0, float)
+
+# Background token refresh: how often to check, and how long before expiry to renew.
+# TOKEN_MAX_AGE_SECONDS is used when the token carries no readable "exp" claim.
+TOKEN_REFRESH_CHECK_INTERVAL = get_setting("token_refresh_check_interval", 30.0, float)
+TOKEN_REFRESH_MARGIN_SECONDS = get_setting("token_refresh_margin_seconds", 300.0, float)
+TOKEN_MAX_AGE_SECONDS = get_setting("token_max_age_seconds", 1800.0, float)
+
+# Per-account pool of pre-created upstream sessions. The background refiller tops a pool up
+# to SESSION_POOL_HIGH once it drops below SESSION_POOL_LOW; sessions older than
+# SESSION_POOL_TTL_SECONDS are discarded instead of handed out. SESSION_POOL_HIGH=0 disables it.
+SESSION_POOL_LOW = get_setting("session_pool_low", 2, int)
+SESSION_POOL_HIGH = get_setting("session_pool_high", 4, int)
+SESSION_POOL_TTL_SECONDS = get_setting("session_pool_ttl_seconds", 1800.0, float)
+SESSION_POOL_CHECK_INTERVAL = get_setting("session_pool_check_interval", 5.0, float)
+
+# Client session affinity store. Entries idle for CLIENT_SESSION_TTL_SECONDS are evicted (the
+# client then gets a fresh session), and at most CLIENT_SESSION_MAX_ENTRIES are kept (LRU).
+# CLIENT_SESSION_BACKEND is "memory" or "sqlite:<path>" to share affinity between worker processes.
+CLIENT_SESSION_TTL_SECONDS = get_setting("client_session_ttl_seconds", 600.0, float)
+CLIENT_SESSION_MAX_ENTRIES = get_setting("client_session_max_entries", 10000, int)
+CLIENT_SESSION_BACKEND = get_setting("client_session_backend", "memory")
+CLIENT_SESSION_SWEEP_INTERVAL = get_setting("client_session_sweep_interval", 60.0, float)
+
+# Admission control in front of upstream queries. At most ADMISSION_MAX_CONCURRENCY queries run
+# at once (0 = ADMISSION_MAX_PER_ACCOUNT times the number of accounts) and no account takes on new
+# sessions beyond ADMISSION_MAX_PER_ACCOUNT (0 = no per-account limit), so while accounts cool down
+# the limit shrinks to what the healthy ones can take. A client whose session lives on a healthy
+# account stays there even above the per-account limit, since moving would lose its context. Excess requests wait in a queue that is served
+# round-robin across clients; when it holds ADMISSION_QUEUE_SIZE requests (or a client already
+# has ADMISSION_QUEUE_PER_CLIENT waiting) new ones are rejected at once with Retry-After.
+ADMISSION_MAX_CONCURRENCY = get_setting("admission_max_concurrency", 0, int)
+ADMISSION_MAX_PER_ACCOUNT = get_setting("admission_max_per_account", 8, int)
+ADMISSION_QUEUE_SIZE = get_setting("admission_queue_size", 100, int)
+ADMISSION_QUEUE_PER_CLIENT = get_setting("admission_queue_per_client", 10, int)
+ADMISSION_QUEUE_TIMEOUT_SECONDS = get_setting("admission_queue_timeout_seconds", 30.0, float)
+
+# Production serving (python 2api.py). With gunicorn installed the app runs under it with
+# SERVER_WORKERS processes, preloaded once and forked; each worker signs in and warms its own
+# clients (use CLIENT_SESSION_BACKEND=sqlite:... to share session affinity between them). Flask
+# mode serves SERVER_THREADS requests per worker. On SIGTERM a worker stops admitting requests
+# (503, /healthz not ready) and lets in-flight streams finish for up to SHUTDOWN_GRACE_SECONDS.
+SERVER_WORKERS = get_setting("server_workers", 1, int)
+SERVER_THREADS = get_setting("server_threads", 32, int)
+SHUTDOWN_GRACE_SECONDS = get_setting("shutdown_grace_seconds", 30.0, float)
+
+
+# ---------------------------------------------------------------------------
+# Metrics (Prometheus text exposition format, served on /metrics)
+# ---------------------------------------------------------------------------
+
+class _Metric:
+    def __init__(self, name: str, documentation: str, metric_type: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        parts = ['%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                 for name, value in zip(self.labelnames, key)]
+        if extra:
+            parts.append(extra)
+        return "{%s}" % ",".join(parts) if parts else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, "counter", labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, "gauge", labelnames)
+        self._values = {}
 
-if not ACCOUNTS:
-    raise ValueError("No accounts found in config.json or environment variable ONDEMAND_ACCOUNTS.")
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
 
-# Current account index (for round-robin selection)
-current_account_index = 0
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
 
-# In-memory storage for session and last interaction time per client
-CLIENT_SESSIONS = {}  # Format: {client_id: {"session_id": str, "last_time": datetime, "user_id": str, "company_id": str, "token": str}}
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{self._format_labels(key)} {value}" for key, value in self._values.items()]
+
+
+class CollectedMetric(_Metric):
+    """A counter or gauge whose samples are read from live objects at scrape time."""
+
+    def __init__(self, name: str, documentation: str, metric_type: str, labelnames: Tuple[str, ...],
+                 collect: Callable[[], Dict[Tuple, float]]):
+        super().__init__(name, documentation, metric_type, labelnames)
+        self._collect = collect
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{self._format_labels(tuple(str(value) for value in key))} {sample}"
+                for key, sample in self._collect().items()]
+
+
+class Histogram(_Metric):
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, "histogram", labelnames)
+        self.buckets = buckets
+        self._series = {}  # label tuple -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            series_items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in series_items:
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{self._format_labels(key, 'le=%s' % json.dumps(str(bound)))} {count}")
+            lines.append(f"{self.name}_bucket{self._format_labels(key, 'le=%s' % json.dumps('+Inf'))} {series[-1]}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {series[-1]}")
+        return lines
+
+
+METRICS = []
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+PHASE_SECONDS = Histogram("ondemand_phase_seconds", "Duration of upstream control calls (sign_in, refresh, create_session).",
+                          ("phase", "account"))
+UPSTREAM_TTFB_SECONDS = Histogram("ondemand_upstream_ttfb_seconds", "Time from sending a query until upstream responds.",
+                                  ("model", "account"))
+FIRST_CHUNK_SECONDS = Histogram("ondemand_first_chunk_seconds", "Time from request arrival to the first chunk sent to the client.",
+                                ("model", "account"))
+REQUEST_DURATION_SECONDS = Histogram("ondemand_request_duration_seconds", "Total chat completion request duration.",
+                                     ("model", "account", "mode"))
+REQUESTS_TOTAL = Counter("ondemand_requests_total", "Chat completion requests by outcome.", ("model", "account", "mode", "status"))
+REQUESTS_IN_FLIGHT = Gauge("ondemand_requests_in_flight", "Chat completion requests currently being served.", ("mode",))
+ERRORS_TOTAL = Counter("ondemand_errors_total", "Failed upstream calls by kind.", ("kind", "account"))
+UPSTREAM_RETRIES_TOTAL = Counter("ondemand_upstream_retries_total", "Upstream queries retried after a failed attempt.", ("account",))
+HEDGED_REQUESTS_TOTAL = Counter("ondemand_hedged_requests_total", "Streaming queries raced against a second attempt, by winner.", ("winner",))
+CLIENT_CANCELLATIONS_TOTAL = Counter("ondemand_client_cancellations_total", "Requests abandoned by the client before the response was complete.", ("mode",))
+ADMISSION_WAIT_SECONDS = Histogram("ondemand_admission_wait_seconds", "Time requests spent queued for an upstream slot.")
+ADMISSION_REJECTED_TOTAL = Counter("ondemand_admission_rejected_total", "Requests rejected by admission control.", ("reason",))
+CollectedMetric("ondemand_log_records_dropped_total", "Log records dropped because the log queue was full.", "counter",
+                (), lambda: {(): _BackgroundQueueHandler.dropped})
+
+
+def timed_phase(phase: str):
+    """Record a client method's duration in PHASE_SECONDS and count falsy results as errors."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            started = time.monotonic()
+            result = None
+            try:
+                result = method(self, *args, **kwargs)
+                return result
+            finally:
+                PHASE_SECONDS.observe(time.monotonic() - started, phase=phase, account=self.account_label)
+                if not result:
+                    ERRORS_TOTAL.inc(kind=phase, account=self.account_label)
+        return wrapper
+    return decorator
+
+
+def render_metrics() -> bytes:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+class ChatRequestMetrics:
+    """Timing and outcome of one chat completion request."""
+
+    def __init__(self, mode: str):
+        self.started = time.monotonic()
+        self.mode = mode
+        self.model = "unknown"
+        self.account = "none"
+        self._first_chunk_seen = False
+        self._finished = False
+        REQUESTS_IN_FLIGHT.inc(mode=mode)
+
+    def upstream_responded(self, ttfb: float):
+        UPSTREAM_TTFB_SECONDS.observe(ttfb, model=self.model, account=self.account)
+
+    def first_chunk(self):
+        if not self._first_chunk_seen:
+            self._first_chunk_seen = True
+            FIRST_CHUNK_SECONDS.observe(time.monotonic() - self.started, model=self.model, account=self.account)
+
+    def finish(self, status: str):
+        if self._finished:
+            return
+        self._finished = True
+        REQUESTS_IN_FLIGHT.dec(mode=self.mode)
+        REQUEST_DURATION_SECONDS.observe(time.monotonic() - self.started, model=self.model, account=self.account,
+                                         mode=self.mode)
+        REQUESTS_TOTAL.inc(model=self.model, account=self.account, mode=self.mode, status=status)
+        logger.info("Chat completion finished", extra={"fields": {
+            "model": self.model, "account": self.account, "mode": self.mode, "status": status,
+            "duration_ms": round((time.monotonic() - self.started) * 1000, 1)}})
+
+
+def abort_upstream(response: requests.Response):
+    """Close an upstream response at once, even while another thread is blocked reading it."""
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        try:
+            # Closing alone waits for the reader; shutting the socket down wakes it immediately
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+class Cancellation:
+    """Set when the client goes away; aborts the upstream responses bound to it and wakes
+    waits registered with on_cancel."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._responses = []
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def bind(self, response: requests.Response):
+        with self._lock:
+            self._responses.append(response)
+            cancelled = self.cancelled
+        if cancelled:
+            abort_upstream(response)
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """Call ``callback`` on cancel, or right away if already cancelled."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            responses, self._responses = self._responses, []
+            callbacks, self._callbacks = self._callbacks, []
+        for response in responses:
+            abort_upstream(response)
+        for callback in callbacks:
+            callback()
+
+
+def cancelled_result() -> Dict:
+    """Result of a query abandoned because the client disconnected."""
+    return {"error": "Client disconnected", "retryable": False, "cancelled": True}
+
+
+def is_retryable_status(status_code: Optional[int]) -> bool:
+    """Connection errors, timeouts, 408, 429 and 5xx may succeed on retry; other client errors will not."""
+    return status_code is None or status_code in (408, 429) or status_code >= 500
 
 
 class OnDemandAPIClient:
@@ -41,11 +569,53 @@ class OnDemandAPIClient:
         self.password = password
         self.token = ""
         self.refresh_token = ""
+        self.token_issued_at = 0.0  # time.time() when the current token was obtained
         self.user_id = ""
         self.company_id = ""
         self.session_id = ""
-        self.base_url = "https://gateway.on-demand.io/v1"
-        self.chat_base_url = "https://api.on-demand.io/chat/v1/client"
+        self.account_label = ""  # metrics label, set by AccountPool
+        self.base_url = ONDEMAND_BASE_URL
+        self.chat_base_url = ONDEMAND_CHAT_BASE_URL
+        self.timeout = (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+        self.http = self._build_http_session()
+        self._async_http = None
+        # Serializes sign-in/refresh so concurrent 401s trigger a single token refresh
+        self._auth_lock = threading.Lock()
+
+    @staticmethod
+    def _build_http_session() -> requests.Session:
+        """Create a keep-alive session so upstream calls reuse pooled TCP/TLS connections."""
+        session = requests.Session()
+        # One pool per upstream host; retries are handled by the callers (401 refresh etc.)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=UPSTREAM_POOL_SIZE, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({
+            'User-Agent': "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36 Edg/135.0.0.0",
+            'Accept': "application/json, text/plain, */*",
+            'Accept-Encoding': "gzip, deflate",
+            'Connection': "keep-alive"
+        })
+        return session
+
+    def _post(self, url: str, payload: Dict, headers: Dict, stream: bool = False,
+              read_timeout: Optional[float] = None) -> requests.Response:
+        """POST a JSON payload through the pooled session with connect/read timeouts.
+
+        ``read_timeout`` replaces the configured read timeout, e.g. to bound the wait for headers.
+        """
+        timeout = self.timeout if read_timeout is None else (self.timeout[0], read_timeout)
+        return self.http.post(url, data=json.dumps(payload), headers=headers, stream=stream, timeout=timeout)
+
+    def _restore_read_timeout(self, response: requests.Response):
+        """Give the body the configured read timeout after the headers arrived under a shorter one."""
+        connection = getattr(response.raw, "connection", None)
+        if connection is not None and connection.sock is not None:
+            connection.sock.settimeout(self.timeout[1])
+
+    def close(self):
+        """Release all pooled upstream connections."""
+        self.http.close()
 
     def get_authorization(self) -> str:
         """Generate Basic Authorization header for login."""
@@ -53,6 +623,7 @@ class OnDemandAPIClient:
         encoded = base64.b64encode(text.encode("utf-8")).decode("utf-8")
         return encoded
 
+    @timed_phase("sign_in")
     def sign_in(self) -> bool:
         """Login to get token, refreshToken, userId, and companyId."""
         url = f"{self.base_url}/auth/user/signin"
@@ -60,41 +631,37 @@ class OnDemandAPIClient:
             "accountType": "default"
         }
         headers = {
-            'User-Agent': "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36 Edg/135.0.0.0",
-            'Accept': "application/json, text/plain, */*",
-            'Accept-Encoding': "gzip, deflate, br, zstd",
             'Content-Type': "application/json",
             'Authorization': f"Basic {self.get_authorization()}",
             'Referer': "https://app.on-demand.io/"
         }
 
         try:
-            response = requests.post(url, data=json.dumps(payload), headers=headers)
+            response = self._post(url, payload, headers)
             response.raise_for_status()
             data = response.json()
-            print("Raw response from sign_in:", json.dumps(data, indent=2))
             self.token = data.get('data', {}).get('tokenData', {}).get('token', '')
             self.refresh_token = data.get('data', {}).get('tokenData', {}).get('refreshToken', '')
             self.user_id = data.get('data', {}).get('user', {}).get('userId', '')
             self.company_id = data.get('data', {}).get('user', {}).get('default_company_id', '')
-            print(f"Extracted Token: {self.token[:10]}... (truncated for security)")
-            print(f"Extracted Refresh Token: {self.refresh_token[:10]}... (truncated for security)")
-            print(f"Extracted User ID: {self.user_id}")
-            print(f"Extracted Company ID: {self.company_id}")
+            self.token_issued_at = time.time()
+            logger.debug("Sign-in response for %s: token=%s refresh_token=%s user_id=%s company_id=%s",
+                          self.email, redact(self.token), redact(self.refresh_token), self.user_id, self.company_id)
             if self.token and self.user_id and self.company_id:
-                print(f"Login successful for {self.email}. Token and user info retrieved.")
+                logger.info("Login successful for %s. Token and user info retrieved.", self.email)
                 return True
             else:
-                print("Login successful but failed to extract required fields.")
+                logger.error("Login for %s succeeded but failed to extract required fields.", self.email)
                 return False
         except requests.exceptions.RequestException as e:
-            print(f"Login failed for {self.email}: {e}")
+            logger.error("Login failed for %s: %s", self.email, e)
             return False
 
+    @timed_phase("refresh")
     def refresh_token_if_needed(self) -> bool:
         """Refresh token if it is expired or invalid."""
         if not self.token or not self.refresh_token:
-            print("No token or refresh token available. Please log in first.")
+            logger.warning("No token or refresh token available for %s. Please log in first.", self.email)
             return False
 
         url = f"{self.base_url}/auth/user/refresh_token"
@@ -109,23 +676,23 @@ class OnDemandAPIClient:
         }
 
         try:
-            response = requests.post(url, data=json.dumps(payload), headers=headers)
+            response = self._post(url, payload, headers)
             response.raise_for_status()
             data = response.json()
-            print("Raw response from refresh_token:", json.dumps(data, indent=2))
             self.token = data.get('data', {}).get('token', '')
             self.refresh_token = data.get('data', {}).get('refreshToken', '')
-            print(f"New Token: {self.token[:10]}... (truncated for security)")
-            print("Token refreshed successfully.")
+            self.token_issued_at = time.time()
+            logger.info("Token refreshed successfully for %s: token=%s", self.email, redact(self.token))
             return True
         except requests.exceptions.RequestException as e:
-            print(f"Token refresh failed: {e}")
+            logger.error("Token refresh failed for %s: %s", self.email, e)
             return False
 
+    @timed_phase("create_session")
     def create_session(self, external_user_id: str = "user-app-12345") -> Optional[str]:
         """Create a new session for chat."""
         if not self.token or not self.user_id or not self.company_id:
-            print("No token or user info available. Please log in or refresh token.")
+            logger.warning("No token or user info available for %s. Please log in or refresh token.", self.email)
             return None
 
         url = f"{self.chat_base_url}/sessions"
@@ -139,39 +706,132 @@ class OnDemandAPIClient:
             'x-company-id': self.company_id,
             'x-user-id': self.user_id
         }
-        print(f"Creating session with company_id: {self.company_id}, user_id: {self.user_id}")
+        logger.debug("Creating session with company_id: %s, user_id: %s", self.company_id, self.user_id)
 
         try:
-            response = requests.post(url, data=json.dumps(payload), headers=headers)
+            response = self._post(url, payload, headers)
             if response.status_code == 401:
-                print("Token expired, refreshing...")
-                if self.refresh_token_if_needed():
+                logger.info("Token for %s expired, refreshing...", self.email)
+                response.close()
+                if self.refresh_after_unauthorized(headers['Authorization']):
                     headers['Authorization'] = f"Bearer {self.token}"
-                    response = requests.post(url, data=json.dumps(payload), headers=headers)
+                    response = self._post(url, payload, headers)
             response.raise_for_status()
             data = response.json()
-            print("Raw response from create_session:", json.dumps(data, indent=2))
+            logger.debug("Raw response from create_session: %s", Excerpt(data))
             self.session_id = data.get('data', {}).get('id', '')
-            print(f"Session created successfully. Session ID: {self.session_id}")
+            logger.debug("Session created successfully. Session ID: %s", self.session_id)
             return self.session_id
         except requests.exceptions.RequestException as e:
-            print(f"Session creation failed: {e}")
+            logger.error("Session creation failed for %s: %s", self.email, e)
             return None
 
-    def send_query(self, query: str, endpoint_id: str = "predefined-claude-3.7-sonnet", stream: bool = False) -> Dict:
-        """Send a query to the chat session and handle streaming or non-streaming response."""
-        if not self.session_id or not self.token:
-            print("No session ID or token available. Please create a session first.")
+    def ensure_signed_in(self) -> bool:
+        """Sign in once; concurrent callers wait for the first attempt instead of logging in again."""
+        if self.token and self.user_id and self.company_id:
+            return True
+        with self._auth_lock:
+            if self.token and self.user_id and self.company_id:
+                return True
+            return self.sign_in()
+
+    def token_expires_at(self) -> float:
+        """Expiry of the current token (epoch seconds), read from its JWT "exp" claim when present."""
+        try:
+            claims_segment = self.token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(claims_segment + "=" * (-len(claims_segment) % 4)))
+            return float(claims["exp"])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return self.token_issued_at + TOKEN_MAX_AGE_SECONDS
+
+    def refresh_if_expiring(self, margin: float) -> bool:
+        """Renew the token ahead of expiry, signing in again if the refresh is rejected."""
+        with self._auth_lock:
+            if not self.token or time.time() + margin < self.token_expires_at():
+                return True
+            logger.info("Token for %s expires soon, refreshing in the background...", self.email)
+            return self.refresh_token_if_needed() or self.sign_in()
+
+    def refresh_after_unauthorized(self, rejected_authorization: str) -> bool:
+        """Refresh the token after a 401, unless a concurrent request already replaced it."""
+        with self._auth_lock:
+            if self.token and f"Bearer {self.token}" != rejected_authorization:
+                return True
+            return self.refresh_token_if_needed()
+
+    def send_query(self, query: str, endpoint_id: str = "predefined-claude-3.7-sonnet", stream: bool = False,
+                   session_id: Optional[str] = None, cancellation: Optional[Cancellation] = None,
+                   options: Optional[Dict] = None, timeout: Optional[float] = None) -> Dict:
+        """Send a query to the chat session and handle streaming or non-streaming response.
+
+        ``session_id`` defaults to the last session created by this client; callers sharing
+        the client between concurrent requests should pass the session they own. The upstream
+        response is bound to ``cancellation`` so a client disconnect can abort it. ``options``
+        carries the per-request generation settings (see upstream_options). ``timeout`` bounds
+        the wait for the response headers (the body is read with UPSTREAM_READ_TIMEOUT).
+        """
+        session_id = session_id or self.session_id
+        if not session_id or not self.token:
+            logger.warning("No session ID or token available for %s. Please create a session first.", self.email)
             return {"error": "No session or token available"}
 
-        url = f"{self.chat_base_url}/sessions/{self.session_id}/query"
+        url, payload, headers = self._query_request(query, endpoint_id, stream, session_id, options)
+
+        try:
+            # Always read the body as a stream so TTFB is measured at the response headers
+            started = time.monotonic()
+            response = self._post(url, payload, headers, stream=True, read_timeout=timeout)
+            if response.status_code == 401:
+                logger.info("Token for %s expired, refreshing...", self.email)
+                response.close()
+                if self.refresh_after_unauthorized(headers['Authorization']):
+                    headers['Authorization'] = f"Bearer {self.token}"
+                    response = self._post(url, payload, headers, stream=True, read_timeout=timeout)
+            if timeout is not None:
+                self._restore_read_timeout(response)
+            if cancellation is not None:
+                cancellation.bind(response)  # aborts it at once if the client has already gone
+                if cancellation.cancelled:
+                    response.close()
+                    return cancelled_result()
+            ttfb = time.monotonic() - started
+            if not response.ok:
+                response.close()
+                response.raise_for_status()
+            if stream:
+                return {"stream": True, "response": response, "ttfb": ttfb}
+            try:
+                chunks = response.iter_content(chunk_size=STREAM_READ_CHUNK_SIZE)
+                content = collect_answer(chunks)
+            finally:
+                response.close()
+            # An aborted body may end early without an error; what was read is incomplete
+            if cancellation is not None and cancellation.cancelled:
+                return cancelled_result()
+            return {"stream": False, "content": content, "ttfb": ttfb}
+        except requests.exceptions.RequestException as e:
+            if cancellation is not None and cancellation.cancelled:
+                return cancelled_result()
+            logger.error("Query failed on account %s: %s", self.account_label, e)
+            ERRORS_TOTAL.inc(kind="query", account=self.account_label)
+            status_code = e.response.status_code if e.response is not None else None
+            return {"error": str(e), "retryable": is_retryable_status(status_code)}
+
+    def _query_request(self, query: str, endpoint_id: str, stream: bool, session_id: str,
+                       options: Optional[Dict] = None) -> Tuple[str, Dict, Dict]:
+        """Build the URL, payload and headers of a session query.
+
+        ``options`` (see upstream_options) overrides reasoningMode, debugMode and modelConfigs fields.
+        """
+        options = options or {}
+        url = f"{self.chat_base_url}/sessions/{session_id}/query"
         payload = {
             "endpointId": endpoint_id,
             "query": query,
             "pluginIds": [],
-            "reasoningMode": "high",
+            "reasoningMode": options.get("reasoningMode", UPSTREAM_REASONING_MODE),
             "responseMode": "stream" if stream else "sync",
-            "debugMode": "on",
+            "debugMode": options.get("debugMode", UPSTREAM_DEBUG_MODE),
             "modelConfigs": {
                 "fulfillmentPrompt": "",
                 "stopTokens": [],
@@ -179,7 +839,8 @@ class OnDemandAPIClient:
                 "temperature": 0,
                 "presencePenalty": 0,
                 "frequencyPenalty": 0,
-                "topP": 1
+                "topP": 1,
+                **options.get("modelConfigs", {})
             },
             "fulfillmentOnly": False
         }
@@ -188,304 +849,2562 @@ class OnDemandAPIClient:
             'Authorization': f"Bearer {self.token}",
             'x-company-id': self.company_id
         }
+        return url, payload, headers
+
+    def _get_async_http(self) -> "httpx.AsyncClient":
+        """Lazily create the pooled asyncio HTTP client used by the ASGI serving mode."""
+        if self._async_http is None:
+            _import_httpx()
+            self._async_http = httpx.AsyncClient(
+                headers=dict(self.http.headers),
+                timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=UPSTREAM_POOL_SIZE)
+            )
+        return self._async_http
+
+    async def _async_post(self, url: str, payload: Dict, headers: Dict, stream: bool = False) -> "httpx.Response":
+        """POST a JSON payload through the asyncio client; the body is left unread when streaming."""
+        http = self._get_async_http()
+        upstream_request = http.build_request("POST", url, content=json.dumps(payload), headers=headers)
+        return await http.send(upstream_request, stream=stream)
+
+    async def async_send_query(self, query: str, endpoint_id: str = "predefined-claude-3.7-sonnet", stream: bool = False,
+                               session_id: Optional[str] = None, options: Optional[Dict] = None,
+                               timeout: Optional[float] = None) -> Dict:
+        """Asyncio counterpart of send_query; the returned stream response is read with aiter_bytes()."""
+        session_id = session_id or self.session_id
+        if not session_id or not self.token:
+            logger.warning("No session ID or token available for %s. Please create a session first.", self.email)
+            return {"error": "No session or token available"}
+
+        url, payload, headers = self._query_request(query, endpoint_id, stream, session_id, options)
 
         try:
-            if stream:
-                response = requests.post(url, data=json.dumps(payload), headers=headers, stream=True)
-                if response.status_code == 401:
-                    print("Token expired, refreshing...")
-                    if self.refresh_token_if_needed():
-                        headers['Authorization'] = f"Bearer {self.token}"
-                        response = requests.post(url, data=json.dumps(payload), headers=headers, stream=True)
-                response.raise_for_status()
-                return {"stream": True, "response": response}
-            else:
-                response = requests.post(url, data=json.dumps(payload), headers=headers)
-                if response.status_code == 401:
-                    print("Token expired, refreshing...")
-                    if self.refresh_token_if_needed():
-                        headers['Authorization'] = f"Bearer {self.token}"
-                        response = requests.post(url, data=json.dumps(payload), headers=headers)
+            started = time.monotonic()
+            response = await asyncio.wait_for(self._async_post(url, payload, headers, stream=True), timeout)
+            if response.status_code == 401:
+                logger.info("Token for %s expired, refreshing...", self.email)
+                await response.aclose()
+                if await asyncio.to_thread(self.refresh_after_unauthorized, headers['Authorization']):
+                    headers['Authorization'] = f"Bearer {self.token}"
+                    response = await asyncio.wait_for(self._async_post(url, payload, headers, stream=True), timeout)
+            ttfb = time.monotonic() - started
+            if response.is_error:
+                await response.aclose()
                 response.raise_for_status()
-                full_answer = ""
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith("data:"):
-                            json_str = decoded_line[len("data:"):]
-                            if json_str == "[DONE]":
-                                break
-                            try:
-                                event_data = json.loads(json_str)
-                                if event_data.get("eventType", "") == "fulfillment":
-                                    full_answer += event_data.get("answer", "")
-                            except json.JSONDecodeError:
-                                continue
-                return {"stream": False, "content": full_answer}
-        except requests.exceptions.RequestException as e:
-            print(f"Query failed: {e}")
-            return {"error": str(e)}
+            if stream:
+                return {"stream": True, "response": response, "ttfb": ttfb}
+            try:
+                chunks = [chunk async for chunk in response.aiter_bytes()]
+            finally:
+                await response.aclose()
+            return {"stream": False, "content": collect_answer(chunks), "ttfb": ttfb}
+        except asyncio.TimeoutError:
+            logger.error("Query failed on account %s: no response headers within %.1fs", self.account_label, timeout)
+            ERRORS_TOTAL.inc(kind="query", account=self.account_label)
+            return {"error": "Timed out waiting for upstream response", "retryable": True}
+        except httpx.HTTPError as e:
+            logger.error("Query failed on account %s: %s", self.account_label, e)
+            ERRORS_TOTAL.inc(kind="query", account=self.account_label)
+            status_code = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            return {"error": str(e), "retryable": is_retryable_status(status_code)}
+
+    async def aclose(self):
+        """Release the pooled connections of the asyncio client."""
+        if self._async_http is not None:
+            await self._async_http.aclose()
+            self._async_http = None
+
+
+class UpstreamEventParser:
+    """Incremental parser for the upstream SSE byte stream.
+
+    Only "eventType" and "answer" are read, and answers are kept as raw JSON string bodies (still
+    escaped) so they can be spliced into OpenAI chunks without a decode/encode round trip. Lines in
+    the upstream's own layout, with "eventType" and then "answer" as the first keys, are read with
+    one regex anchored at the start of the object, so both keys are known to be top level. Other
+    lines (no string answer, keys in another order or occurring more than once, e.g. nested in
+    metadata) fall back to json.loads.
+    """
+    _EVENT_RE = re.compile(rb'\{\s*"eventType"\s*:\s*"([^"\\]*)"(?:\s*,\s*"answer"\s*:\s*"((?:[^"\\]|\\.)*)")?')
+
+    def __init__(self):
+        self._partial = b""
+        self.done = False
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Consume upstream bytes; returns the escaped answers of the complete lines received."""
+        if self.done:
+            return []
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        answers = []
+        for line in lines:
+            answer = self._parse_line(line)
+            if self.done:
+                break
+            if answer:
+                answers.append(answer)
+        return answers
+
+    def finish(self) -> List[bytes]:
+        """Parse a trailing line that was not newline-terminated."""
+        partial, self._partial = self._partial, b""
+        answer = None if self.done else self._parse_line(partial)
+        return [answer] if answer else []
+
+    def _parse_line(self, line: bytes) -> Optional[bytes]:
+        if not line.startswith(b"data:"):
+            return None
+        payload = line[len(b"data:"):].strip()
+        if payload == b"[DONE]":
+            self.done = True
+            return None
+        if payload.count(b'"eventType"') == 1:
+            match = self._EVENT_RE.match(payload)
+            if match is not None:
+                if match.group(1) != b"fulfillment":
+                    return None
+                if match.group(2) is not None and payload.count(b'"answer"') == 1:
+                    return match.group(2)
+        try:
+            event_data = json.loads(payload)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(event_data, dict) or event_data.get("eventType") != "fulfillment":
+            return None
+        answer = event_data.get("answer")
+        if not isinstance(answer, str):
+            return None
+        return json.dumps(answer)[1:-1].encode("utf-8")
+
+
+def decode_answer(escaped: bytes) -> str:
+    return json.loads(b'"' + escaped + b'"')
+
+
+def collect_answer(chunks: Iterable[bytes]) -> str:
+    """Join the fulfillment answers of an upstream SSE byte stream into the full reply."""
+    parser = UpstreamEventParser()
+    parts = []
+    for chunk in chunks:
+        parts.extend(parser.feed(chunk))
+        if parser.done:
+            break
+    parts.extend(parser.finish())
+    return decode_answer(b"".join(parts))
+
+
+def new_completion_id() -> str:
+    return f"chatcmpl-{uuid.uuid4().hex[:24]}"
+
+
+class StreamTranslator:
+    """Renders upstream SSE bytes as OpenAI chat.completion.chunk events.
+
+    Every chunk of one response shares a completion id and timestamp, so each event is a
+    precomputed prefix + the escaped upstream answer + a fixed suffix. With
+    ``usage_prompt_tokens`` set (the client asked for stream_options.include_usage) a final
+    chunk carries the estimated token usage.
+    """
+
+    def __init__(self, model: str, coalesce_bytes: int = STREAM_COALESCE_BYTES,
+                 coalesce_ms: float = STREAM_COALESCE_MS, usage_prompt_tokens: Optional[int] = None):
+        self.completion_id = new_completion_id()
+        self.created = int(time.time())
+        self.model = model
+        self.usage_prompt_tokens = usage_prompt_tokens
+        self._answers = []  # escaped answers, kept only to count completion tokens
+        self._prefix = ('data: {"id":"%s","object":"chat.completion.chunk","created":%d,"model":%s,'
+                        '"choices":[{"delta":{"content":"' % (self.completion_id, self.created, json.dumps(model))
+                        ).encode("utf-8")
+        self._suffix = b'"},"index":0,"finish_reason":null}]}\n\n'
+        self._parser = UpstreamEventParser()
+        self._coalesce_bytes = coalesce_bytes
+        self._coalesce_seconds = coalesce_ms / 1000.0
+        self._pending = []
+        self._pending_size = 0
+        self._pending_since = 0.0
+
+    @property
+    def done(self) -> bool:
+        return self._parser.done
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Consume upstream bytes; returns the SSE events to send to the client now."""
+        events = []
+        for answer in self._parser.feed(data):
+            self._add(answer, events)
+        if self._pending and self._window_elapsed():
+            self._flush(events)
+        if self._parser.done:
+            self._flush(events)
+            if self.usage_prompt_tokens is not None:
+                events.append(self._usage_event())
+            events.append(b"data: [DONE]\n\n")
+        return events
+
+    def finish(self) -> List[bytes]:
+        """Flush buffered content once upstream has closed the stream."""
+        events = []
+        for answer in self._parser.finish():
+            self._add(answer, events)
+        self._flush(events)
+        return events
+
+    def _usage_event(self) -> bytes:
+        completion_tokens = approx_tokens(decode_answer(b"".join(self._answers)))
+        return b"data: " + json.dumps({
+            "id": self.completion_id, "object": "chat.completion.chunk", "created": self.created,
+            "model": self.model, "choices": [],
+            "usage": {"prompt_tokens": self.usage_prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": self.usage_prompt_tokens + completion_tokens}
+        }, separators=(",", ":")).encode("utf-8") + b"\n\n"
+
+    def _add(self, answer: bytes, events: List[bytes]):
+        if self.usage_prompt_tokens is not None:
+            self._answers.append(answer)
+        if not self._coalesce_bytes and not self._coalesce_seconds:
+            events.append(self._prefix + answer + self._suffix)
+            return
+        if not self._pending:
+            self._pending_since = time.monotonic()
+        self._pending.append(answer)
+        self._pending_size += len(answer)
+        if self._coalesce_bytes and self._pending_size >= self._coalesce_bytes:
+            self._flush(events)
+
+    def _window_elapsed(self) -> bool:
+        return not self._coalesce_seconds or time.monotonic() - self._pending_since >= self._coalesce_seconds
+
+    def _flush(self, events: List[bytes]):
+        if self._pending:
+            events.append(self._prefix + b"".join(self._pending) + self._suffix)
+            self._pending = []
+            self._pending_size = 0
+
+
+class _CacheFlight:
+    """An upstream call that concurrent identical requests wait on instead of repeating."""
+    __slots__ = ("event", "result")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class ResponseCache:
+    """LRU + TTL cache of non-streaming completions with request coalescing.
+
+    Only successful answers are cached. While a key is being computed, identical requests wait
+    for that call (a threading.Event for Flask workers, an asyncio.Future in ASGI mode) rather
+    than sending their own upstream query.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, directory: str = "", directory_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self.directory_max_bytes = directory_max_bytes
+        self._entries = OrderedDict()  # key -> (content, expires_at, size)
+        self._size = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(model: str, endpoint_id: str, messages: List[Tuple[str, str]], options: Optional[Dict] = None) -> str:
+        """Key of a conversation given as (role, text) pairs."""
+        normalized = json.dumps([model.strip().lower(), endpoint_id, [[role, text.strip()] for role, text in messages],
+                                 options or {}], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        content = self._get_memory(key)
+        if content is None and self.directory:
+            content = self._get_disk(key)
+        return content
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                del self._entries[key]
+                self._size -= entry[2]
+        return None
+
+    def _get_disk(self, key: str) -> Optional[str]:
+        now = time.time()
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except OSError:
+            return None
+        except ValueError:
+            stored = {}  # Corrupt entry; removed below like an expired one
+        if stored.get("expires_at", 0) <= now:
+            self._remove_file(path)
+            return None
+        self._remember(key, stored["content"], stored["expires_at"])
+        return stored["content"]
+
+    @staticmethod
+    def _remove_file(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:  # Already removed by another worker
+            return False
 
+    def sweep_disk(self) -> int:
+        """Delete expired disk entries, then the least recently written ones while the directory
+        exceeds directory_max_bytes; returns how many files were removed."""
+        if not self.directory:
+            return 0
+        # Entries expire ttl seconds after they were written, so the file's mtime is enough
+        expire_before = time.time() - self.ttl
+        removed = 0
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                # Temporary files are left behind only by a worker that died while writing
+                if stat.st_mtime < expire_before or (name.endswith(".tmp") and stat.st_mtime < time.time() - 60):
+                    removed += self._remove_file(path)
+                elif name.endswith(".json"):
+                    files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        if self.directory_max_bytes > 0 and total > self.directory_max_bytes:
+            files.sort()
+            for _, size, path in files:
+                if total <= self.directory_max_bytes:
+                    break
+                removed += self._remove_file(path)
+                total -= size
+        return removed
 
-# Initialize the first client with the first account
-def get_next_client():
-    global current_account_index
-    account = ACCOUNTS[current_account_index]
-    email = account.get('email')
-    password = account.get('password')
-    print(f"Using account: {email}")
-    current_account_index = (current_account_index + 1) % len(ACCOUNTS)  # Round-robin to next account
-    return OnDemandAPIClient(email, password)
+    def _remember(self, key: str, content: str, expires_at: float):
+        size = sys.getsizeof(content)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[2]
+            self._entries[key] = (content, expires_at, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted[2]
 
+    def put(self, key: str, content: str):
+        expires_at = time.time() + self.ttl
+        self._remember(key, content, expires_at)
+        if self.directory:
+            self._put_disk(key, content, expires_at)
 
-# Current client (will be replaced when switching accounts)
-current_client = get_next_client()
+    def _put_disk(self, key: str, content: str, expires_at: float):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"content": content, "expires_at": expires_at}, f, ensure_ascii=False)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning("Failed to write response cache entry: %s", e)
 
-# Global variable to track initialization
-initialized = False
+    @staticmethod
+    def _directives(cache_control: str) -> set:
+        return {directive.strip().lower() for directive in (cache_control or "").split(",")}
 
+    def _store(self, key: str, result: Dict):
+        if "content" in result:
+            self.put(key, result["content"])
 
-@app.before_request
-def initialize_client():
-    global initialized, current_client
-    if not initialized:
-        if current_client.sign_in():
-            current_client.create_session()
-            initialized = True
+    def get_or_compute(self, key: str, compute, cache_control: str = "") -> Tuple[Dict, str]:
+        """Return (result, cache status) where status is HIT, MISS or BYPASS."""
+        directives = self._directives(cache_control)
+        if "no-store" in directives:
+            return compute(), "BYPASS"
+        if "no-cache" not in directives:
+            content = self.get(key)
+            if content is not None:
+                self.hits += 1
+                return {"stream": False, "content": content}, "HIT"
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _CacheFlight()
+            if not leader:
+                self.coalesced += 1
+                flight.event.wait()
+                return flight.result, "HIT" if "content" in flight.result else "MISS"
         else:
-            print("Initialization failed. Switching to next account.")
-            current_client = get_next_client()
-            initialize_client()  # Recursive call with new client
+            flight = None
+        self.misses += 1
+        result = {"error": "Upstream call failed"}
+        try:
+            result = compute()
+            self._store(key, result)
+            return result, "MISS"
+        finally:
+            if flight is not None:
+                flight.result = result
+                with self._lock:
+                    del self._flights[key]
+                flight.event.set()
 
+    async def aget_or_compute(self, key: str, compute, cache_control: str = "") -> Tuple[Dict, str]:
+        """Asyncio counterpart of get_or_compute; ``compute`` is a coroutine function. Disk reads
+        and writes run in a worker thread so they never block the event loop."""
+        directives = self._directives(cache_control)
+        if "no-store" in directives:
+            return await compute(), "BYPASS"
+        if "no-cache" not in directives:
+            content = self._get_memory(key)
+            if content is None and self.directory:
+                content = await asyncio.to_thread(self._get_disk, key)
+            if content is not None:
+                self.hits += 1
+                return {"stream": False, "content": content}, "HIT"
+            flight = self._async_flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                result = await asyncio.shield(flight)
+                return result, "HIT" if "content" in result else "MISS"
+            flight = self._async_flights[key] = asyncio.get_running_loop().create_future()
+        else:
+            flight = None
+        self.misses += 1
+        result = {"error": "Upstream call failed"}
+        try:
+            result = await compute()
+            expires_at = time.time() + self.ttl
+            if "content" in result:
+                self._remember(key, result["content"], expires_at)
+        finally:
+            if flight is not None:
+                del self._async_flights[key]
+                flight.set_result(result)
+        # Waiting requests already have the answer; the disk copy is only for later ones
+        if self.directory and "content" in result:
+            await asyncio.to_thread(self._put_disk, key, result["content"], expires_at)
+        return result, "MISS"
 
-@app.route('/v1/models', methods=['GET'])
-def get_models():
-    """Return a list of available models in OpenAI format."""
-    models_response = {
-        "object": "list",
-        "data": [
-            {
-                "id": "gpto3-mini",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "on-demand.io"
-            },
-            {
-                "id": "gpt-4o",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "on-demand.io"
-            },
-            {
-                "id": "gpt-4.1",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "on-demand.io"
-            },
-            {
-                "id": "gpt-4.1-mini",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "on-demand.io"
-            },
-            {
-                "id": "gpt-4.1-nano",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "on-demand.io"
-            },
-            {
-                "id": "gpt-4o-mini",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "on-demand.io"
-            },
-            {
-                "id": "deepseek-v3",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "on-demand.io"
-            },
-            {
-                "id": "deepseek-r1",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "on-demand.io"
-            },
-            {
-                "id": "claude-3.7-sonnet",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "on-demand.io"
-            },
-            {
-                "id": "gemini-2.0-flash",
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "on-demand.io"
-            }
-        ]
-    }
-    return models_response
 
+# None unless RESPONSE_CACHE_ENABLED; created by initialize()
+response_cache: Optional[ResponseCache]
 
-@app.route('/v1/chat/completions', methods=['POST'])
-def chat_completions():
-    global current_client
-    data = request.get_json()
-    print("Received OpenAI request:", json.dumps(data, indent=2))
 
-    # Extract client ID (use IP address as a simple identifier for different clients)
-    client_id = request.remote_addr  # Alternatively, use a unique ID from request if provided by Cherry Studio
+class ClientSession:
+    """Session affinity record of one client: its upstream session and the account that owns it."""
+    __slots__ = ("session_id", "account_index", "last_time")
 
-    # Check last interaction time for this client
-    current_time = datetime.now()
-    if client_id in CLIENT_SESSIONS:
-        last_time = CLIENT_SESSIONS[client_id].get("last_time")
-        if last_time and current_time - last_time > timedelta(minutes=10):
-            print(f"Client {client_id} inactive for over 10 minutes. Switching session or account.")
-            # Option 1: Create new session with current account
-            new_session = current_client.create_session()
-            if new_session:
-                CLIENT_SESSIONS[client_id]["session_id"] = new_session
-                print(f"New session created for client {client_id}: {new_session}")
-            else:
-                # Option 2: If session creation fails, switch account
-                print("Failed to create new session. Switching to next account.")
-                current_client = get_next_client()
-                if current_client.sign_in():
-                    new_session = current_client.create_session()
-                    if new_session:
-                        CLIENT_SESSIONS[client_id] = {
-                            "session_id": new_session,
-                            "last_time": current_time,
-                            "user_id": current_client.user_id,
-                            "company_id": current_client.company_id,
-                            "token": current_client.token
-                        }
-                        print(f"Switched account and created new session for client {client_id}: {new_session}")
-                    else:
-                        return {"error": "Failed to create session with new account"}, 500
-                else:
-                    return {"error": "Failed to login with new account"}, 500
-    else:
-        # New client, use current session or create one
-        if not current_client.session_id:
-            if not current_client.sign_in() or not current_client.create_session():
-                return {"error": "Failed to initialize client session"}, 500
-        CLIENT_SESSIONS[client_id] = {
-            "session_id": current_client.session_id,
-            "last_time": current_time,
-            "user_id": current_client.user_id,
-            "company_id": current_client.company_id,
-            "token": current_client.token
-        }
+    def __init__(self, session_id: str, account_index: int, last_time: float):
+        self.session_id = session_id
+        self.account_index = account_index
+        self.last_time = last_time  # time.time() of the last request
 
-    # Update last interaction time
-    CLIENT_SESSIONS[client_id]["last_time"] = current_time
 
-    # Extract parameters from OpenAI request
-    messages = data.get('messages', [])
-    stream = data.get('stream', False)
-    model = data.get('model', 'claude-3.7-sonnet')
+class SessionBackend:
+    """Storage interface for ClientSession records, keyed by client id."""
 
-    if not messages:
-        return {"error": "No messages found in request"}, 400
+    def get(self, client_id: str) -> Optional[ClientSession]:
+        raise NotImplementedError
 
-    # Extract only the latest user message as the query (rely on session_id for context)
-    latest_user_query = ""
-    for msg in reversed(messages):
-        if msg.get('role', '') == 'user':
-            latest_user_query = msg.get('content', '')
-            break
-    if not latest_user_query:
-        return {"error": "No user message found in request"}, 400
+    def put(self, client_id: str, record: ClientSession):
+        raise NotImplementedError
 
-    # Add explicit instruction to reply in Chinese and be direct
-    query = f"请用英文思考,用中文回答以下问题，不要提及上下文或推理过程：{latest_user_query}"
-    print(f"Constructed Query for on-demand.io (relying on session_id for context, with Chinese instruction): {query}")
-
-    # Map the model ID to on-demand.io endpoint ID
-    model_mapping = {
-        "gpto3-mini": "predefined-openai-gpto3-mini",
-        "gpt-4o": "predefined-openai-gpt4o",
-        "gpt-4.1": "predefined-openai-gpt4.1",
-        "gpt-4.1-mini": "predefined-openai-gpt4.1-mini",
-        "gpt-4.1-nano": "predefined-openai-gpt4.1-nano",
-        "gpt-4o-mini": "predefined-openai-gpt4o-mini",
-        "deepseek-v3": "predefined-deepseek-v3",
-        "deepseek-r1": "predefined-deepseek-r1",
-        "claude-3.7-sonnet": "predefined-claude-3.7-sonnet",
-        "gemini-2.0-flash": "predefined-gemini-2.0-flash"
-    }
-    endpoint_id = model_mapping.get(model, "predefined-claude-3.7-sonnet")  # Default to Claude if model not found
+    def delete(self, client_id: str):
+        raise NotImplementedError
 
-    # Send query to OnDemand API
-    result = current_client.send_query(query, endpoint_id=endpoint_id, stream=stream)
+    def sweep(self, expire_before: float) -> int:
+        """Drop records last used before ``expire_before``; returns how many were removed."""
+        raise NotImplementedError
 
-    if "error" in result:
-        return {"error": result["error"]}, 500
-
-    if stream:
-        def generate_stream():
-            for line in result["response"].iter_lines():
-                if line:
-                    decoded_line = line.decode('utf-8')
-                    if decoded_line.startswith("data:"):
-                        json_str = decoded_line[len("data:"):]
-                        if json_str == "[DONE]":
-                            yield "data: [DONE]\n\n"
-                            break
-                        try:
-                            event_data = json.loads(json_str)
-                            if event_data.get("eventType", "") == "fulfillment":
-                                content = event_data.get("answer", "")
-                                stream_response = {
-                                    "id": f"chatcmpl-{int(time.time())}",
-                                    "object": "chat.completion.chunk",
-                                    "created": int(time.time()),
-                                    "model": model,
-                                    "choices": [
-                                        {
-                                            "delta": {"content": content},
-                                            "index": 0,
-                                            "finish_reason": None
-                                        }
-                                    ]
-                                }
-                                yield f"data: {json.dumps(stream_response)}\n\n"
-                        except json.JSONDecodeError:
-                            continue
-
-        return Response(stream_with_context(generate_stream()), content_type='text/event-stream')
-    else:
-        response = {
-            "id": f"chatcmpl-{int(time.time())}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": model,
-            "choices": [
-                {
-                    "message": {
-                        "role": "assistant",
-                        "content": result["content"]
-                    },
-                    "finish_reason": "stop",
-                    "index": 0
-                }
-            ],
-            "usage": {
-                "prompt_tokens": 0,  # Placeholder, can be updated if metrics are available
-                "completion_tokens": 0,
-                "total_tokens": 0
-            }
-        }
-        return response
+    def __len__(self) -> int:
+        raise NotImplementedError
 
 
-if __name__ == "__main__":
-    # Get port from environment variable (Hugging Face Spaces uses PORT env var)
-    port = int(os.getenv("PORT", 7860))
-    print(f"Starting Flask app on port {port}")
-    # Run the Flask app with host 0.0.0.0 to be accessible in Docker
-    app.run(host='0.0.0.0', port=port, debug=False)
+class MemorySessionBackend(SessionBackend):
+    """Process-local LRU map; the default when only one worker process serves requests."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, client_id: str) -> Optional[ClientSession]:
+        with self._lock:
+            record = self._records.get(client_id)
+            if record is not None:
+                self._records.move_to_end(client_id)
+            return record
+
+    def put(self, client_id: str, record: ClientSession):
+        with self._lock:
+            self._records[client_id] = record
+            self._records.move_to_end(client_id)
+            while len(self._records) > self.max_entries:
+                self._records.popitem(last=False)
+
+    def delete(self, client_id: str):
+        with self._lock:
+            self._records.pop(client_id, None)
+
+    def sweep(self, expire_before: float) -> int:
+        with self._lock:
+            expired = [client_id for client_id, record in self._records.items() if record.last_time < expire_before]
+            for client_id in expired:
+                del self._records[client_id]
+            return len(expired)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+
+class SqliteSessionBackend(SessionBackend):
+    """SQLite file shared by several worker processes on one host, so session affinity survives
+    requests landing on different workers. LRU is approximated by evicting the oldest last_time."""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS client_sessions ("
+                       "client_id TEXT PRIMARY KEY, session_id TEXT NOT NULL, "
+                       "account_index INTEGER NOT NULL, last_time REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS client_sessions_last_time ON client_sessions (last_time)")
+        # Not kept open: a preloaded app must not hand this connection down to forked workers
+        db.close()
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, client_id: str) -> Optional[ClientSession]:
+        row = self._connect().execute(
+            "SELECT session_id, account_index, last_time FROM client_sessions WHERE client_id = ?",
+            (client_id,)).fetchone()
+        return ClientSession(*row) if row else None
+
+    def put(self, client_id: str, record: ClientSession):
+        db = self._connect()
+        db.execute("INSERT OR REPLACE INTO client_sessions VALUES (?, ?, ?, ?)",
+                   (client_id, record.session_id, record.account_index, record.last_time))
+        self._writes += 1
+        if self._writes % 100 == 0:  # Enforcing the bound costs a scan, so only do it now and then
+            db.execute("DELETE FROM client_sessions WHERE client_id IN ("
+                       "SELECT client_id FROM client_sessions ORDER BY last_time DESC LIMIT -1 OFFSET ?)",
+                       (self.max_entries,))
+
+    def delete(self, client_id: str):
+        self._connect().execute("DELETE FROM client_sessions WHERE client_id = ?", (client_id,))
+
+    def sweep(self, expire_before: float) -> int:
+        return self._connect().execute("DELETE FROM client_sessions WHERE last_time < ?", (expire_before,)).rowcount
+
+    def __len__(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM client_sessions").fetchone()[0]
+
+
+class ClientSessionStore:
+    """Bounded client id -> ClientSession map with TTL expiry on top of a SessionBackend."""
+
+    def __init__(self, backend: SessionBackend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+
+    def get(self, client_id: str) -> Optional[ClientSession]:
+        """Return the client's record, or None if it is unknown or has been idle longer than the TTL."""
+        record = self.backend.get(client_id)
+        if record is not None and time.time() - record.last_time > self.ttl:
+            self.backend.delete(client_id)
+            return None
+        return record
+
+    def put(self, client_id: str, session_id: str, account_index: int):
+        self.backend.put(client_id, ClientSession(session_id, account_index, time.time()))
+
+    def sweep(self) -> int:
+        return self.backend.sweep(time.time() - self.ttl)
+
+    def __len__(self) -> int:
+        return len(self.backend)
+
+
+def create_session_backend(spec: str, max_entries: int) -> SessionBackend:
+    """Build a backend from CLIENT_SESSION_BACKEND ("memory" or "sqlite:<path>")."""
+    if spec.startswith("sqlite:"):
+        return SqliteSessionBackend(spec[len("sqlite:"):], max_entries)
+    if spec != "memory":
+        logger.warning("Unknown client session backend %r. Using in-memory storage.", spec)
+    return MemorySessionBackend(max_entries)
+
+
+# Storage for session and last interaction time per client; created by initialize()
+CLIENT_SESSIONS: ClientSessionStore
+
+
+class SessionPool:
+    """Ready-to-use upstream session ids for one account, refilled in the background."""
+
+    def __init__(self, client: OnDemandAPIClient, low: int = SESSION_POOL_LOW, high: int = SESSION_POOL_HIGH,
+                 ttl: float = SESSION_POOL_TTL_SECONDS):
+        self.client = client
+        self.low = min(low, high)
+        self.high = high
+        self.ttl = ttl
+        self._sessions = deque()  # (session_id, time.monotonic() at creation), oldest first
+        self._lock = threading.Lock()
+        self._refilling = False
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def _discard_stale(self, now: float):
+        while self._sessions and now - self._sessions[0][1] > self.ttl:
+            self._sessions.popleft()
+            self.discarded += 1
+
+    def take(self) -> Optional[str]:
+        """Pop the newest fresh session, or None on a miss (the caller then creates one itself)."""
+        with self._lock:
+            self._discard_stale(time.monotonic())
+            if self._sessions:
+                self.hits += 1
+                return self._sessions.pop()[0]
+            self.misses += 1
+            return None
+
+    def needs_refill(self) -> bool:
+        with self._lock:
+            self._discard_stale(time.monotonic())
+            return len(self._sessions) < self.low
+
+    def refill(self, target: Optional[int] = None) -> int:
+        """Create sessions until ``target`` (default: the high watermark) are ready; returns how many were added."""
+        target = self.high if target is None else min(target, self.high)
+        with self._lock:
+            if self._refilling:
+                return 0
+            self._refilling = True
+        added = 0
+        try:
+            while True:
+                with self._lock:
+                    if len(self._sessions) >= target:
+                        break
+                session_id = self.client.create_session()
+                if not session_id:
+                    break
+                with self._lock:
+                    self._sessions.append((session_id, time.monotonic()))
+                added += 1
+        finally:
+            with self._lock:
+                self._refilling = False
+        return added
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"ready": len(self._sessions), "hits": self.hits, "misses": self.misses, "discarded": self.discarded}
+
+
+class AccountSlot:
+    """One configured account: its client plus scheduling and health state."""
+
+    def __init__(self, index: int, client: OnDemandAPIClient):
+        self.index = index
+        self.client = client
+        self.sessions = SessionPool(client)
+        self.outstanding = 0  # requests currently leasing this account
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0  # time.monotonic() deadline of the current cooldown
+
+    def is_healthy(self, now: float) -> bool:
+        """Circuit breaker: open while cooling down, then half-open (one trial request at a
+        time) until a success closes it or a failure opens it again."""
+        if now < self.unhealthy_until:
+            return False
+        if self.consecutive_failures >= ACCOUNT_FAILURE_THRESHOLD:
+            return self.outstanding == 0
+        return True
+
+
+class AccountPool:
+    """Leases one signed-in OnDemandAPIClient per account using least-outstanding-requests scheduling.
+
+    Accounts that fail ACCOUNT_FAILURE_THRESHOLD times in a row are skipped for
+    ACCOUNT_COOLDOWN_SECONDS. All bookkeeping happens under one lock; network calls
+    (sign in, session creation, queries) run outside it.
+    """
+
+    def __init__(self, accounts, max_per_account: int = ADMISSION_MAX_PER_ACCOUNT):
+        self.slots = [AccountSlot(index, OnDemandAPIClient(account.get('email'), account.get('password')))
+                      for index, account in enumerate(accounts)]
+        for slot in self.slots:
+            slot.client.account_label = str(slot.index)
+        self.max_per_account = max_per_account
+        self._lock = threading.Lock()
+        self._rotation = 0  # breaks ties between equally loaded accounts
+
+    def _has_room(self, slot: AccountSlot) -> bool:
+        return self.max_per_account <= 0 or slot.outstanding < self.max_per_account
+
+    def capacity(self) -> int:
+        """Queries the accounts can serve at once within max_per_account (0 = no per-account limit).
+
+        Accounts cooling down add nothing and a half-open one a single trial request; when every
+        account is cooling down, requests degrade to one account as in acquire().
+        """
+        if self.max_per_account <= 0:
+            return 0
+        now = time.monotonic()
+        capacity = 0
+        for slot in self.slots:
+            if now < slot.unhealthy_until:
+                continue
+            capacity += 1 if slot.consecutive_failures >= ACCOUNT_FAILURE_THRESHOLD else self.max_per_account
+        return capacity or self.max_per_account
+
+    def acquire(self, preferred: Optional[int] = None, exclude: Iterable[int] = ()) -> AccountSlot:
+        """Lease an account, sticking to ``preferred`` while it is healthy.
+
+        The preferred account holds the client's upstream session, so it is kept even at its
+        limit: only a failing account breaks affinity, not a busy one.
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [slot for slot in self.slots if slot.index not in exclude] or self.slots
+            if preferred is not None and 0 <= preferred < len(self.slots) and self.slots[preferred] in candidates \
+                    and self.slots[preferred].is_healthy(now):
+                slot = self.slots[preferred]
+            else:
+                healthy = [slot for slot in candidates if slot.is_healthy(now)]
+                # Admission control caps the total at capacity(), so some healthy account has room;
+                # a retry goes back to an excluded account rather than push another over its limit.
+                # Only an account failing after its requests were admitted leaves none, and then
+                # the least loaded one goes over.
+                open_slots = [slot for slot in healthy if self._has_room(slot)] or \
+                    [slot for slot in self.slots if slot.is_healthy(now) and self._has_room(slot)]
+                if open_slots or healthy:
+                    count = len(self.slots)
+                    slot = min(open_slots or healthy, key=lambda s: (s.outstanding, (s.index - self._rotation) % count))
+                    self._rotation = (slot.index + 1) % count
+                else:
+                    # Every candidate is cooling down: degrade to the one that recovers first
+                    slot = min(candidates, key=lambda s: s.unhealthy_until)
+            slot.outstanding += 1
+            return slot
+
+    def release(self, slot: AccountSlot, ok: Optional[bool] = True):
+        """Return a lease and record whether the account served it successfully (None: neither,
+        e.g. the client went away)."""
+        with self._lock:
+            slot.outstanding -= 1
+            if ok is not None:
+                self._record_result(slot, ok)
+
+    def _record_result(self, slot: AccountSlot, ok: bool):
+        if ok:
+            slot.consecutive_failures = 0
+            slot.unhealthy_until = 0.0
+        else:
+            slot.consecutive_failures += 1
+            if slot.consecutive_failures >= ACCOUNT_FAILURE_THRESHOLD:
+                logger.warning("Account %d failed %d times in a row. Cooling down for %ss.",
+                               slot.index, slot.consecutive_failures, ACCOUNT_COOLDOWN_SECONDS)
+                slot.unhealthy_until = time.monotonic() + ACCOUNT_COOLDOWN_SECONDS
+
+    def _warm_up_account(self, slot: AccountSlot) -> bool:
+        ok = slot.client.ensure_signed_in()
+        if ok:
+            # Only fill to the low watermark here; the background refiller does the rest
+            slot.sessions.refill(max(slot.sessions.low, 1))
+        with self._lock:
+            self._record_result(slot, ok)
+        return ok
+
+    def warm_up(self) -> int:
+        """Sign in every account concurrently and pre-create its first sessions; returns the ready count."""
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(self.slots), thread_name_prefix="warm-up") as executor:
+            ready = sum(executor.map(self._warm_up_account, self.slots))
+        logger.info("Warm-up finished: %d/%d accounts ready in %.2fs", ready, len(self.slots), time.monotonic() - started)
+        return ready
+
+    def refill_session_pools(self):
+        """Top up the session pools of signed-in, healthy accounts that fell below the low watermark."""
+        now = time.monotonic()
+        for slot in self.slots:
+            if slot.client.token and slot.is_healthy(now) and slot.sessions.needs_refill():
+                added = slot.sessions.refill()
+                logger.debug("Session pool for account %d refilled with %d sessions: %s",
+                             slot.index, added, slot.sessions.stats())
+
+    def session_pool_stats(self) -> Dict[int, Dict]:
+        return {slot.index: slot.sessions.stats() for slot in self.slots}
+
+    def refresh_expiring_tokens(self):
+        """Renew tokens close to expiry so requests rarely hit a 401."""
+        for slot in self.slots:
+            if slot.client.token and not slot.client.refresh_if_expiring(TOKEN_REFRESH_MARGIN_SECONDS):
+                with self._lock:
+                    self._record_result(slot, False)
+
+    async def aclose(self):
+        for slot in self.slots:
+            slot.client.close()
+            await slot.client.aclose()
+
+
+class _AdmissionWaiter:
+    __slots__ = ("client_id", "granted", "notify")
+
+    def __init__(self, client_id: str, notify: Callable[[], None]):
+        self.client_id = client_id
+        self.granted = False
+        self.notify = notify  # called outside the lock once the waiter holds a slot
+
+
+class AdmissionController:
+    """Limits concurrent upstream queries and queues the excess fairly across clients.
+
+    Waiting requests are kept in one FIFO per client and slots are handed out round-robin
+    over the clients, so a client sending a burst cannot starve the others. When the queue is
+    full the request is rejected immediately (503, or 429 when the client alone exceeds its
+    share) with a Retry-After estimated from recent slot hold times. With ``capacity`` set the
+    limit is lowered to what it returns (e.g. AccountPool.capacity while accounts cool down).
+    """
+
+    def __init__(self, limit: int, max_queue: int = ADMISSION_QUEUE_SIZE,
+                 max_queued_per_client: int = ADMISSION_QUEUE_PER_CLIENT,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SECONDS,
+                 capacity: Optional[Callable[[], int]] = None):
+        self.limit = limit  # 0 = unlimited
+        self.capacity = capacity  # returns 0 for no limit of its own
+        self.max_queue = max_queue
+        self.max_queued_per_client = max_queued_per_client
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.draining = False  # set on shutdown: nothing new is admitted
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()  # client_id -> waiters, in round-robin order
+        self._hold_seconds = 1.0  # moving average of how long a slot is held
+        self._lock = threading.Lock()
+
+    def _current_limit(self) -> int:
+        capacity = self.capacity() if self.capacity is not None else 0
+        if capacity <= 0 or 0 < self.limit <= capacity:
+            return self.limit
+        return capacity
+
+    def _enter(self, client_id: str, notify: Callable[[], None]):
+        """Take a slot or join the queue; returns (waiter or None if admitted, rejection or None)."""
+        with self._lock:
+            if self.draining:
+                return None, self._rejection("draining", 503, "Server is shutting down")
+            limit = self._current_limit()
+            if limit <= 0 or (self.in_flight < limit and not self.queued):
+                self.in_flight += 1
+                return None, None
+            client_queue = self._queues.get(client_id)
+            if client_queue is not None and len(client_queue) >= self.max_queued_per_client:
+                return None, self._rejection("client_queue_full", 429, "Too many queued requests from this client")
+            if self.queued >= self.max_queue:
+                return None, self._rejection("queue_full", 503, "Server is overloaded, please retry later")
+            waiter = _AdmissionWaiter(client_id, notify)
+            if client_queue is None:
+                client_queue = self._queues[client_id] = deque()
+            client_queue.append(waiter)
+            self.queued += 1
+            return waiter, None
+
+    def _rejection(self, reason: str, status: int, message: str) -> Tuple[Dict, int, Dict[str, str]]:
+        ADMISSION_REJECTED_TOTAL.inc(reason=reason)
+        # Rough time until the work ahead of a new request has drained
+        retry_after = int(self._hold_seconds * (self.queued + 1) / max(self._current_limit(), 1)) + 1
+        return {"error": message}, status, {"Retry-After": str(retry_after)}
+
+    def try_admit(self) -> Optional[float]:
+        """Take a slot only if one is free right now, for optional work such as hedged attempts."""
+        with self._lock:
+            limit = self._current_limit()
+            if self.draining or (limit > 0 and (self.in_flight >= limit or self.queued)):
+                return None
+            self.in_flight += 1
+            return time.monotonic()
+
+    def _abandon(self, waiter: _AdmissionWaiter) -> bool:
+        """Remove a waiter that gave up; False if it was granted a slot in the meantime."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            client_queue = self._queues[waiter.client_id]
+            client_queue.remove(waiter)
+            if not client_queue:
+                del self._queues[waiter.client_id]
+            self.queued -= 1
+            return True
+
+    def _timed_out(self) -> Tuple[Dict, int, Dict[str, str]]:
+        with self._lock:
+            return self._rejection("queue_timeout", 503, "Timed out waiting for an upstream slot")
+
+    def admit(self, client_id: str, cancellation: Optional[Cancellation] = None
+              ) -> Tuple[Optional[float], Optional[Tuple[Dict, int, Dict[str, str]]]]:
+        """Block until an upstream slot is free.
+
+        Returns (admitted_at, None), or (None, (error_body, status_code, headers)) when rejected.
+        A queued request gives up its place when ``cancellation`` is cancelled (the rejection is
+        then a 499). An admitted caller must hand the slot back with release(admitted_at).
+        """
+        queued_at = time.monotonic()
+        granted = threading.Event()
+        waiter, rejection = self._enter(client_id, granted.set)
+        if rejection:
+            return None, rejection
+        if waiter is not None:
+            if cancellation is not None:
+                cancellation.on_cancel(granted.set)
+            if not granted.wait(self.queue_timeout) and self._abandon(waiter):
+                return None, self._timed_out()
+            if cancellation is not None and cancellation.cancelled and self._abandon(waiter):
+                return None, ({"error": "Client disconnected"}, 499, {})
+        admitted_at = time.monotonic()
+        ADMISSION_WAIT_SECONDS.observe(admitted_at - queued_at)
+        return admitted_at, None
+
+    async def aadmit(self, client_id: str) -> Tuple[Optional[float], Optional[Tuple[Dict, int, Dict[str, str]]]]:
+        """Asyncio counterpart of admit; waiting does not block the event loop."""
+        queued_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter, rejection = self._enter(client_id, notify)
+        if rejection:
+            return None, rejection
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if self._abandon(waiter):
+                    return None, self._timed_out()
+            except asyncio.CancelledError:
+                if not self._abandon(waiter):
+                    self.release(time.monotonic())
+                raise
+        admitted_at = time.monotonic()
+        ADMISSION_WAIT_SECONDS.observe(admitted_at - queued_at)
+        return admitted_at, None
+
+    def release(self, admitted_at: float):
+        """Free a slot and grant it to the next client in round-robin order."""
+        to_notify = []
+        with self._lock:
+            self.in_flight -= 1
+            self._hold_seconds += 0.1 * (time.monotonic() - admitted_at - self._hold_seconds)
+            limit = self._current_limit()
+            while self._queues and (limit <= 0 or self.in_flight < limit):
+                client_id, client_queue = next(iter(self._queues.items()))
+                waiter = client_queue.popleft()
+                if client_queue:
+                    self._queues.move_to_end(client_id)
+                else:
+                    del self._queues[client_id]
+                self.queued -= 1
+                self.in_flight += 1
+                waiter.granted = True
+                to_notify.append(waiter.notify)
+        for notify in to_notify:
+            notify()
+
+    def drain(self):
+        """Reject new requests from now on; queued and in-flight ones still complete."""
+        with self._lock:
+            self.draining = True
+
+    @property
+    def idle(self) -> bool:
+        return self.in_flight == 0 and self.queued == 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"in_flight": self.in_flight, "queued": self.queued, "waiting_clients": len(self._queues),
+                    "limit": self._current_limit(), "draining": self.draining}
+
+
+# Created by initialize(), not at import
+account_pool: AccountPool
+admission: AdmissionController
+
+CollectedMetric("ondemand_account_outstanding_requests", "Requests currently leasing each account.", "gauge",
+                ("account",), lambda: {(slot.index,): slot.outstanding for slot in account_pool.slots})
+CollectedMetric("ondemand_account_healthy", "1 if the account is not cooling down after failures.", "gauge",
+                ("account",), lambda: {(slot.index,): int(slot.is_healthy(time.monotonic())) for slot in account_pool.slots})
+CollectedMetric("ondemand_session_pool_ready", "Pre-created upstream sessions ready per account.", "gauge",
+                ("account",), lambda: {(index,): stats["ready"] for index, stats in account_pool.session_pool_stats().items()})
+CollectedMetric("ondemand_session_pool_hits_total", "Requests served a pre-created session.", "counter",
+                ("account",), lambda: {(index,): stats["hits"] for index, stats in account_pool.session_pool_stats().items()})
+CollectedMetric("ondemand_session_pool_misses_total", "Requests that had to create a session themselves.", "counter",
+                ("account",), lambda: {(index,): stats["misses"] for index, stats in account_pool.session_pool_stats().items()})
+CollectedMetric("ondemand_client_sessions", "Client session affinity records held.", "gauge",
+                (), lambda: {(): len(CLIENT_SESSIONS)})
+CollectedMetric("ondemand_admission_queue_depth", "Requests waiting for an upstream slot.", "gauge",
+                (), lambda: {(): admission.queued})
+CollectedMetric("ondemand_admission_waiting_clients", "Distinct clients with queued requests.", "gauge",
+                (), lambda: {(): admission.stats()["waiting_clients"]})
+CollectedMetric("ondemand_admission_in_flight", "Upstream slots currently held.", "gauge",
+                (), lambda: {(): admission.in_flight})
+CollectedMetric("ondemand_response_cache_requests_total", "Response cache lookups by result.", "counter",
+                ("result",), lambda: {} if response_cache is None else {
+                    ("hit",): response_cache.hits, ("miss",): response_cache.misses,
+                    ("coalesced",): response_cache.coalesced})
+
+# Process state below is built on first use by initialize(), so importing this module does no I/O
+# beyond reading the settings and starts no threads: tooling can import it without accounts, and a
+# cold start only pays for what the chosen serving mode needs.
+_LAZY_GLOBALS = ("account_pool", "admission", "CLIENT_SESSIONS", "response_cache", "model_registry",
+                 "_attempt_executor")
+_initialized = False
+_initialize_lock = threading.Lock()
+
+
+def initialize():
+    """Configure logging and build the account pool, admission control, session store, response
+    cache and model registry (once per process). Raises ValueError when no accounts are configured."""
+    global _initialized, account_pool, admission, CLIENT_SESSIONS, response_cache, model_registry, \
+        _attempt_executor
+    if _initialized:
+        return
+    with _initialize_lock:
+        if _initialized:
+            return
+        if not ACCOUNTS:
+            raise ValueError("No accounts found in config.json or environment variable ONDEMAND_ACCOUNTS.")
+        configure_logging()
+        account_pool = AccountPool(ACCOUNTS)
+        admission = AdmissionController(ADMISSION_MAX_CONCURRENCY or ADMISSION_MAX_PER_ACCOUNT * len(account_pool.slots),
+                                        capacity=account_pool.capacity)
+        CLIENT_SESSIONS = ClientSessionStore(create_session_backend(CLIENT_SESSION_BACKEND, CLIENT_SESSION_MAX_ENTRIES),
+                                             CLIENT_SESSION_TTL_SECONDS)
+        response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_DIR,
+                                       RESPONSE_CACHE_DIR_MAX_BYTES) if RESPONSE_CACHE_ENABLED else None
+        model_registry = ModelRegistry()
+        _attempt_executor = ThreadPoolExecutor(max_workers=max(32, 2 * admission.limit),
+                                               thread_name_prefix="upstream-attempt")
+        _initialized = True
+
+
+def __getattr__(name: str):
+    # Module attributes built on first access: the process state above and the default Flask app
+    if name in _LAZY_GLOBALS:
+        initialize()
+        return globals()[name]
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Set on shutdown to stop background threads
+shutdown_event = threading.Event()
+# Set when a request drains a session pool so the refiller runs without waiting for its next tick
+session_refill_wanted = threading.Event()
+_background_started = False
+_background_lock = threading.Lock()
+
+
+def _token_refresher_loop():
+    while not shutdown_event.wait(TOKEN_REFRESH_CHECK_INTERVAL):
+        try:
+            account_pool.refresh_expiring_tokens()
+        except Exception as e:  # Keep the refresher alive whatever happens
+            logger.exception("Background token refresh failed: %s", e)
+
+
+def _session_refiller_loop():
+    while not shutdown_event.is_set():
+        try:
+            account_pool.refill_session_pools()
+        except Exception as e:  # Keep the refiller alive whatever happens
+            logger.exception("Background session refill failed: %s", e)
+        session_refill_wanted.wait(SESSION_POOL_CHECK_INTERVAL)
+        session_refill_wanted.clear()
+
+
+def _client_session_sweeper_loop():
+    while not shutdown_event.wait(CLIENT_SESSION_SWEEP_INTERVAL):
+        try:
+            removed = CLIENT_SESSIONS.sweep()
+            if removed:
+                logger.debug("Evicted %d idle client sessions (%d remaining)", removed, len(CLIENT_SESSIONS))
+        except Exception as e:  # Keep the sweeper alive whatever happens
+            logger.exception("Client session sweep failed: %s", e)
+
+
+def _response_cache_sweeper_loop():
+    while not shutdown_event.wait(RESPONSE_CACHE_SWEEP_INTERVAL):
+        try:
+            removed = response_cache.sweep_disk()
+            if removed:
+                logger.debug("Removed %d response cache files", removed)
+        except Exception as e:  # Keep the sweeper alive whatever happens
+            logger.exception("Response cache sweep failed: %s", e)
+
+
+def start_background_tasks():
+    """Start warming up all accounts and the background maintenance threads (once per process).
+
+    Serving does not wait for the warm-up: a request arriving first signs in on demand, and
+    /healthz reports "starting" until an account is ready.
+    """
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    initialize()
+    threading.Thread(target=account_pool.warm_up, name="warm-up", daemon=True).start()
+    threading.Thread(target=_token_refresher_loop, name="token-refresher", daemon=True).start()
+    threading.Thread(target=_client_session_sweeper_loop, name="client-session-sweeper", daemon=True).start()
+    if SESSION_POOL_HIGH > 0:
+        threading.Thread(target=_session_refiller_loop, name="session-refiller", daemon=True).start()
+    if response_cache is not None and response_cache.directory:
+        threading.Thread(target=_response_cache_sweeper_loop, name="response-cache-sweeper", daemon=True).start()
+
+
+def ensure_background_tasks():
+    # Fallback for servers that import the app without running __main__
+    if not _background_started:
+        start_background_tasks()
+
+
+def readiness() -> Tuple[Dict, int]:
+    """Body and status of /healthz: ready (200) while at least one account is signed in and
+    healthy and the process is not draining, 503 otherwise."""
+    now = time.monotonic()
+    accounts = [{"account": slot.index, "signed_in": bool(slot.client.token), "healthy": slot.is_healthy(now),
+                 "outstanding": slot.outstanding, "sessions_ready": slot.sessions.stats()["ready"]}
+                for slot in account_pool.slots]
+    if admission.draining:
+        status = "draining"
+    elif any(account["signed_in"] and account["healthy"] for account in accounts):
+        status = "ready"
+    else:
+        status = "starting"
+    body = {"status": status, "pid": os.getpid(), "accounts": accounts, "admission": admission.stats()}
+    return body, 200 if status == "ready" else 503
+
+
+def begin_drain():
+    if not admission.draining:
+        logger.info("Shutting down: draining %d in-flight requests (grace period %ss)",
+                    admission.in_flight, SHUTDOWN_GRACE_SECONDS)
+        admission.drain()
+
+
+def _exit_when_idle():
+    deadline = time.monotonic() + SHUTDOWN_GRACE_SECONDS
+    while not admission.idle and time.monotonic() < deadline:
+        time.sleep(0.1)
+    _thread.interrupt_main()
+
+
+def install_drain_handler():
+    """Make SIGTERM start draining before the server's own SIGTERM handling runs.
+
+    The server's handler (uvicorn, gunicorn) then stops accepting connections and waits for open
+    ones. Without one (the Flask development server) the process is interrupted once in-flight
+    requests have finished or SHUTDOWN_GRACE_SECONDS have passed.
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        begin_drain()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            # interrupt_main raises KeyboardInterrupt only if SIGINT has its default handler, which
+            # processes started in the background (nohup, "cmd &") do not have
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            threading.Thread(target=_exit_when_idle, name="drain", daemon=True).start()
+
+    try:
+        signal.signal(signal.SIGTERM, handle_sigterm)
+    except ValueError:  # Not the main thread (app embedded in another server); nothing to chain
+        pass
+
+
+class DisconnectWatcher:
+    """Notices WSGI clients hanging up while their request is still being served.
+
+    A blocked upstream read would otherwise only find out at the next failed write. One thread
+    polls the client sockets that werkzeug and gunicorn expose in the environ with a selector
+    (epoll or poll where available, so any file descriptor works); a readable socket that peeks
+    EOF means the client is gone and its callback runs.
+    """
+
+    def __init__(self, interval: float = 0.25):
+        self.interval = interval
+        self._selector = None  # created with the thread, so forked workers never share it
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def client_socket(environ: Dict) -> Optional[socket.socket]:
+        return environ.get("werkzeug.socket") or environ.get("gunicorn.socket")
+
+    def watch(self, sock: Optional[socket.socket], on_disconnect: Callable[[], None]):
+        if sock is None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._selector = selectors.DefaultSelector()
+                self._thread = threading.Thread(target=self._run, name="disconnect-watcher", daemon=True)
+                self._thread.start()
+            try:
+                self._selector.register(sock, selectors.EVENT_READ, on_disconnect)
+            except KeyError:
+                # A socket closed without being unwatched left its file descriptor registered
+                self._selector.unregister(sock)
+                self._selector.register(sock, selectors.EVENT_READ, on_disconnect)
+            except (OSError, ValueError):
+                pass  # Already closed: nothing to watch
+
+    def unwatch(self, sock: Optional[socket.socket]):
+        if sock is None:
+            return
+        with self._lock:
+            if self._selector is None:
+                return
+            try:
+                self._selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+    @staticmethod
+    def _hung_up(sock: socket.socket) -> Optional[bool]:
+        """For a readable socket: True if the peer closed, False if not, None if it cannot be checked."""
+        try:
+            return sock.recv(1, socket.MSG_PEEK | getattr(socket, "MSG_DONTWAIT", 0)) == b""
+        except BlockingIOError:
+            return False
+        except (OSError, ValueError):
+            return None  # e.g. already closed, or a TLS socket that cannot be peeked
+
+    def _run(self):
+        while not shutdown_event.wait(self.interval):
+            with self._lock:
+                # Selecting on nothing fails on Windows
+                ready = self._selector.select(0) if self._selector.get_map() else []
+            for key, _ in ready:
+                hung_up = self._hung_up(key.fileobj)
+                if hung_up is False:
+                    continue
+                self.unwatch(key.fileobj)
+                if hung_up:
+                    try:
+                        key.data()
+                    except Exception as e:  # Keep the watcher alive whatever happens
+                        logger.exception("Disconnect callback failed: %s", e)
+
+
+disconnect_watcher = DisconnectWatcher()
+
+
+# Built-in model list, used when neither MODELS_FILE nor MODELS defines one
+BUILTIN_MODELS = {
+    "gpto3-mini": "predefined-openai-gpto3-mini",
+    "gpt-4o": "predefined-openai-gpt4o",
+    "gpt-4.1": "predefined-openai-gpt4.1",
+    "gpt-4.1-mini": "predefined-openai-gpt4.1-mini",
+    "gpt-4.1-nano": "predefined-openai-gpt4.1-nano",
+    "gpt-4o-mini": "predefined-openai-gpt4o-mini",
+    "deepseek-v3": "predefined-deepseek-v3",
+    "deepseek-r1": "predefined-deepseek-r1",
+    "claude-3.7-sonnet": "predefined-claude-3.7-sonnet",
+    "gemini-2.0-flash": "predefined-gemini-2.0-flash"
+}
+BUILTIN_DEFAULT_MODEL = "claude-3.7-sonnet"  # used for unknown model ids
+# "created" of models that do not set one; fixed so every worker serves the same bytes and ETag
+MODELS_CREATED = 1735689600
+
+
+class ModelInfo:
+    __slots__ = ("id", "endpoint_id", "defaults", "created")
+
+    def __init__(self, model_id: str, endpoint_id: str, defaults: Optional[Dict] = None, created: int = MODELS_CREATED):
+        self.id = model_id
+        self.endpoint_id = endpoint_id
+        self.defaults = defaults or {}  # per-model request defaults
+        self.created = created
+
+
+class ModelCatalog:
+    """One immutable snapshot of the registry, with its /v1/models response serialized once."""
+
+    def __init__(self, models: List[ModelInfo], default_model: str):
+        self.models = {model.id: model for model in models}
+        self.default = self.models.get(default_model) or models[0]
+        self.body = json.dumps({
+            "object": "list",
+            "data": [{"id": model.id, "object": "model", "created": model.created, "owned_by": "on-demand.io"}
+                     for model in models]
+        }).encode("utf-8")
+        self.etag = '"%s"' % hashlib.sha256(self.body).hexdigest()[:32]
+
+    @classmethod
+    def parse(cls, spec, default_model: str) -> "ModelCatalog":
+        """Build a catalog from ``{"id": "endpoint-id" | {"endpoint_id", "defaults", "created"}}``
+        or a list of ``{"id", "endpoint_id", ...}`` objects."""
+        if isinstance(spec, dict):
+            spec = [dict(entry, id=model_id) if isinstance(entry, dict) else {"id": model_id, "endpoint_id": entry}
+                    for model_id, entry in spec.items()]
+        if not isinstance(spec, list) or not spec:
+            raise ValueError("models must be a non-empty object or list")
+        models = []
+        for entry in spec:
+            if not isinstance(entry, dict) or not entry.get("id") or not entry.get("endpoint_id"):
+                raise ValueError(f"model entries need an id and an endpoint_id: {entry!r}")
+            models.append(ModelInfo(str(entry["id"]), str(entry["endpoint_id"]), dict(entry.get("defaults") or {}),
+                                    int(entry.get("created", MODELS_CREATED))))
+        return cls(models, default_model)
+
+
+class ModelRegistry:
+    """Public model ids mapped to upstream endpoints, reloaded when the models file changes."""
+
+    def __init__(self, path: str = MODELS_FILE, reload_interval: float = MODELS_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._next_check = 0.0
+        self._reload_lock = threading.Lock()
+        self._catalog = self._load()
+
+    def _file_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self) -> ModelCatalog:
+        self._mtime = self._file_mtime()
+        source = {}
+        if self._mtime is not None:
+            with open(self.path, 'r') as f:
+                source = json.load(f)
+        if "models" in source:
+            spec = source["models"]
+        elif os.getenv("MODELS"):
+            spec = json.loads(os.getenv("MODELS"))
+        else:
+            spec = BUILTIN_MODELS
+        default_model = source.get("default_model") or os.getenv("DEFAULT_MODEL") or BUILTIN_DEFAULT_MODEL
+        return ModelCatalog.parse(spec, default_model)
+
+    def current(self) -> ModelCatalog:
+        """The current catalog, reloading it first if the models file has changed."""
+        now = time.monotonic()
+        if now >= self._next_check and self._reload_lock.acquire(blocking=False):
+            try:
+                self._next_check = now + self.reload_interval
+                if self._file_mtime() != self._mtime:
+                    self._reload()
+            finally:
+                self._reload_lock.release()
+        return self._catalog
+
+    def _reload(self):
+        try:
+            catalog = self._load()
+        except (OSError, ValueError, TypeError) as e:  # json.JSONDecodeError is a ValueError
+            logger.warning("Failed to reload models from %s, keeping the previous list: %s", self.path, e)
+            return
+        self._catalog = catalog
+        logger.info("Reloaded %d models from %s", len(catalog.models), self.path)
+
+    def resolve(self, model_id: str) -> Tuple[ModelInfo, bool]:
+        """Return (model, known); unknown ids resolve to the default model."""
+        catalog = self.current()
+        model = catalog.models.get(model_id)
+        return (model, True) if model is not None else (catalog.default, False)
+
+
+model_registry: ModelRegistry  # created by initialize()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {tag.strip() for tag in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def get_models():
+    """Return the available models in OpenAI format, revalidated with an ETag."""
+    from flask import request, Response
+    catalog = model_registry.current()
+    headers = {"ETag": catalog.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("If-None-Match"), catalog.etag):
+        return Response(status=304, headers=headers)
+    return Response(catalog.body, content_type="application/json", headers=headers)
+
+
+def approx_tokens(text: str) -> int:
+    """Fast token estimate: about four ASCII characters per token, one token per other character."""
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 3) // 4 + len(text) - ascii_chars
+
+
+def message_text(content) -> str:
+    """Text of a message's content, which is a string or a list of typed parts."""
+    if isinstance(content, list):
+        return "".join(part["text"] for part in content if isinstance(part, dict) and isinstance(part.get("text"), str))
+    return content if isinstance(content, str) else ""
+
+
+class PromptTurn:
+    """One rendered message of a conversation prompt."""
+    __slots__ = ("role", "content", "text", "tokens")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+        self.text = f"{role.capitalize()}: {content}\n\n"
+        self.tokens = approx_tokens(self.text)
+
+    def matches(self, message: Dict) -> bool:
+        return self.role == str(message.get("role", "user")) and self.content == message_text(message.get("content"))
+
+    def tail(self, max_tokens: int) -> "PromptTurn":
+        """This turn with its content cut to the tail that fits in ``max_tokens`` (at least one character)."""
+        overhead = PromptTurn(self.role, "").tokens
+        keep_chars = max(1, len(self.content) * max(max_tokens - overhead, 1) // self.tokens)
+        turn = PromptTurn(self.role, self.content[-keep_chars:])
+        # The estimate is not linear in the length, so shrink until it fits
+        while turn.tokens > max_tokens and keep_chars > 1:
+            keep_chars = max(1, keep_chars - (turn.tokens - max_tokens))
+            turn = PromptTurn(self.role, self.content[-keep_chars:])
+        return turn
+
+
+class RenderedPrompt:
+    """Rendered turns of a conversation with their joined text and token total."""
+    __slots__ = ("turns", "text", "tokens")
+
+    def __init__(self, turns: List[PromptTurn], text: Optional[str] = None, tokens: Optional[int] = None):
+        self.turns = turns
+        self.text = "".join(turn.text for turn in turns) if text is None else text
+        self.tokens = sum(turn.tokens for turn in turns) if tokens is None else tokens
+
+    def extend(self, turns: List[PromptTurn]) -> "RenderedPrompt":
+        """A new prompt continuing this one; only the added turns are joined and counted."""
+        if not turns:
+            return self
+        return RenderedPrompt(self.turns + turns, self.text + "".join(turn.text for turn in turns),
+                              self.tokens + sum(turn.tokens for turn in turns))
+
+
+class PromptPrefixCache:
+    """Each client's last rendered conversation, in LRU order.
+
+    Clients resend the whole history every turn. When a request continues the cached
+    conversation only its new messages are rendered, counted and appended to the cached text;
+    a conversation edited part way through is re-rendered from the first changed turn.
+    """
+
+    def __init__(self, max_entries: int = PROMPT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, RenderedPrompt]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, client_id: str, messages: List[Dict]) -> RenderedPrompt:
+        with self._lock:
+            cached = self._entries.get(client_id)
+        cached_turns = cached.turns if cached else []
+        shared = 0  # leading turns unchanged since the cached conversation
+        limit = min(len(cached_turns), len(messages))
+        while shared < limit and cached_turns[shared].matches(messages[shared]):
+            shared += 1
+        new_turns = [PromptTurn(str(message.get("role", "user")), message_text(message.get("content")))
+                     for message in messages[shared:]]
+        if cached and shared == len(cached_turns):
+            rendered = cached.extend(new_turns)
+        else:
+            rendered = RenderedPrompt(cached_turns[:shared] + new_turns)
+        with self._lock:
+            self._entries[client_id] = rendered
+            self._entries.move_to_end(client_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rendered
+
+
+def fit_prompt(prompt: RenderedPrompt, max_tokens: int) -> RenderedPrompt:
+    """Drop turns until the prompt fits in ``max_tokens``: the latest message is always kept, then
+    system messages, then the most recent turns. A latest message too long for what is left is cut
+    to its tail, but system messages never take more than half the budget from it."""
+    if max_tokens <= 0 or prompt.tokens <= max_tokens:
+        return prompt
+    turns = prompt.turns
+    last = turns[-1]
+    reserved = min(last.tokens, (max_tokens + 1) // 2)
+    budget = max_tokens - reserved
+    kept = set()
+    for index, turn in enumerate(turns[:-1]):
+        if turn.role == "system" and turn.tokens <= budget:
+            kept.add(index)
+            budget -= turn.tokens
+    budget += reserved
+    if last.tokens > budget:
+        last = last.tail(budget)
+    budget -= last.tokens
+    for index in range(len(turns) - 2, -1, -1):
+        turn = turns[index]
+        if turn.role != "system":
+            if turn.tokens > budget:
+                break
+            kept.add(index)
+            budget -= turn.tokens
+    return RenderedPrompt([turn for index, turn in enumerate(turns[:-1]) if index in kept] + [last])
+
+
+prompt_prefix_cache = PromptPrefixCache()
+
+
+def stop_tokens(value) -> List[str]:
+    """OpenAI ``stop`` is a string or a list of strings."""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and all(isinstance(token, str) for token in value):
+        return value
+    raise ValueError("stop must be a string or a list of strings")
+
+
+def switch(value) -> str:
+    """Upstream on/off flags also accept JSON booleans."""
+    if isinstance(value, bool):
+        return "on" if value else "off"
+    value = str(value).lower()
+    if value not in ("on", "off"):
+        raise ValueError("expected on or off")
+    return value
+
+
+def choice(*values: str) -> Callable:
+    """Cast for a parameter that takes one of a fixed set of strings."""
+    def cast(value):
+        if value not in values:
+            raise ValueError(f"expected one of {', '.join(values)}")
+        return value
+    return cast
+
+
+def number(kind: type, low: Optional[float] = None, high: Optional[float] = None) -> Callable:
+    """Cast for a numeric parameter: a finite JSON number (not a boolean) or numeric string within
+    [low, high]; integers also accept whole floats such as 256.0."""
+    def cast(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError("expected a number")
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError("expected a finite number")
+        if (low is not None and value < low) or (high is not None and value > high):
+            raise ValueError(f"expected a number in [{low if low is not None else '-inf'}, "
+                             f"{high if high is not None else 'inf'}]")
+        if kind is int:
+            if not value.is_integer():
+                raise ValueError("expected an integer")
+            return int(value)
+        return value
+    return cast
+
+
+# OpenAI request parameter -> (upstream payload key, cast); modelConfigs keys are nested
+QUERY_PARAMETERS = {
+    "reasoning_effort": ("reasoningMode", choice("low", "medium", "high")),
+    "debug_mode": ("debugMode", switch),
+}
+# Set only by a model's registry defaults; requests cannot turn them on
+DEFAULTS_ONLY_PARAMETERS = {"debug_mode"}
+MODEL_CONFIG_PARAMETERS = {
+    "max_tokens": ("maxTokens", number(int, 0)),
+    "max_completion_tokens": ("maxTokens", number(int, 0)),
+    "temperature": ("temperature", number(float, 0, 2)),
+    "top_p": ("topP", number(float, 0, 1)),
+    "presence_penalty": ("presencePenalty", number(float, -2, 2)),
+    "frequency_penalty": ("frequencyPenalty", number(float, -2, 2)),
+    "stop": ("stopTokens", stop_tokens),
+}
+
+
+def upstream_options(data: Dict, model_defaults: Dict) -> Tuple[Optional[Dict], Optional[Tuple[Dict, int]]]:
+    """Merge the model's defaults and the request's parameters into query options for
+    OnDemandAPIClient._query_request. Returns (options, None) or (None, (error_body, 400))."""
+    options = {"reasoningMode": UPSTREAM_REASONING_MODE, "debugMode": UPSTREAM_DEBUG_MODE, "modelConfigs": {}}
+    for from_request, source in ((False, model_defaults), (True, data)):
+        for name, value in source.items():
+            if value is None or (from_request and name in DEFAULTS_ONLY_PARAMETERS):
+                continue
+            if name in QUERY_PARAMETERS:
+                key, cast = QUERY_PARAMETERS[name]
+                target = options
+            elif name in MODEL_CONFIG_PARAMETERS:
+                key, cast = MODEL_CONFIG_PARAMETERS[name]
+                target = options["modelConfigs"]
+            else:
+                continue
+            try:
+                target[key] = cast(value)
+            except (TypeError, ValueError) as e:
+                return None, ({"error": f"Invalid value for '{name}': {value!r} ({e})"}, 400)
+    return options, None
+
+
+def parse_chat_request(data: Dict, client_id: str = "") -> Tuple[Optional[Dict], Optional[Tuple[Dict, int]]]:
+    """Extract the upstream query, endpoint and options from an OpenAI chat request.
+
+    Shared by the Flask and ASGI handlers. Returns (chat, None) on success or
+    (None, (error_body, status_code)) when the request is invalid.
+    """
+    if sample_payload():
+        logger.debug("Received OpenAI request: %s", Excerpt(data))
+
+    # Extract parameters from OpenAI request
+    messages = data.get('messages', [])
+    stream = data.get('stream', False)
+    model = data.get('model', 'claude-3.7-sonnet')
+
+    if not messages:
+        return None, ({"error": "No messages found in request"}, 400)
+    if not isinstance(messages, list) or not all(
+            isinstance(msg, dict) and isinstance(msg.get('role', ''), str) for msg in messages):
+        return None, ({"error": "'messages' must be a list of message objects"}, 400)
+    if not isinstance(model, str):
+        return None, ({"error": "'model' must be a string"}, 400)
+    stream_options = data.get("stream_options") or {}
+    if not isinstance(stream_options, dict):
+        return None, ({"error": "'stream_options' must be an object"}, 400)
+
+    # Extract only the latest user message as the query (rely on session_id for context)
+    latest_user_query = ""
+    for msg in reversed(messages):
+        if msg.get('role', '') == 'user':
+            latest_user_query = message_text(msg.get('content', ''))
+            break
+    if not latest_user_query:
+        return None, ({"error": "No user message found in request"}, 400)
+
+    full_conversation = CONVERSATION_MODE == "full"
+    if full_conversation:
+        # Forward the whole conversation; the upstream session then carries no context of its own
+        rendered = fit_prompt(prompt_prefix_cache.render(client_id, messages), PROMPT_MAX_TOKENS)
+        prompt = rendered.text + "Assistant:"
+        prompt_tokens = rendered.tokens + 2
+    else:
+        prompt = latest_user_query
+        prompt_tokens = approx_tokens(prompt)
+
+    # Add explicit instruction to reply in Chinese and be direct
+    instruction = "请用英文思考,用中文回答以下问题，不要提及上下文或推理过程："
+    query = f"{instruction}{prompt}"
+    logger.debug("Constructed query for on-demand.io: %s", Excerpt(query, 200))
+
+    # Map the model ID to on-demand.io endpoint ID (unknown ids get the default model)
+    model_info, known_model = model_registry.resolve(model)
+    endpoint_id = model_info.endpoint_id
+
+    # Metrics label: unknown model names are folded together to bound label cardinality
+    model_label = model if known_model else "other"
+
+    options, error = upstream_options(data, model_info.defaults)
+    if error:
+        return None, error
+
+    # Without the upstream session's context the answer depends on the request alone, so it may
+    # be cached; a single user turn is then sent on a new session instead of the client's current one
+    single_turn = sum(1 for msg in messages if msg.get('role', '') != 'system') == 1
+    cache_key = None
+    if (RESPONSE_CACHE_ENABLED and not stream and (full_conversation or single_turn)
+            and options["modelConfigs"].get("temperature", 0) <= 0):
+        conversation = [(msg.get('role', ''), message_text(msg.get('content', ''))) for msg in messages]
+        cache_key = ResponseCache.key(model, endpoint_id, conversation, options)
+
+    return {"query": query, "endpoint_id": endpoint_id, "model": model, "model_label": model_label,
+            "upstream_options": options, "stream": stream, "sticky_session": not full_conversation,
+            "new_session": cache_key is not None and not full_conversation, "cache_key": cache_key,
+            "prompt_tokens": approx_tokens(instruction) + prompt_tokens,
+            "include_usage": bool(stream_options.get("include_usage"))}, None
+
+
+def lease_client_session(client_id: str, exclude: Iterable[int] = (), sticky: bool = True, new: bool = False
+                         ) -> Tuple[Optional[Tuple[AccountSlot, str]], Optional[Tuple[Dict, int]]]:
+    """Lease an account and the upstream session this client should use.
+
+    Accounts in ``exclude`` are avoided while others are available. With ``sticky`` off the
+    request gets a fresh session that is not remembered for the client; with ``new`` set it gets
+    a fresh session that replaces the client's current one. Returns
+    ((slot, session_id), None) on success or (None, (error_body, status_code)). The caller
+    must hand the slot back with account_pool.release().
+    """
+    # Look up this client's session; clients idle for longer than the TTL have been evicted and
+    # get a new one. A session belongs to the account that created it, so the client sticks to
+    # that account while it is healthy.
+    client_session = CLIENT_SESSIONS.get(client_id) if sticky and not new else None
+    session_id = client_session.session_id if client_session else None
+    preferred_account = client_session.account_index if client_session else None
+
+    slot = account_pool.acquire(preferred_account, exclude)
+    if slot.index != preferred_account:
+        session_id = None  # The previous account is cooling down; its session cannot be reused
+    if not session_id:
+        # Take a pre-created session (or create one on a pool miss), switching to the
+        # least loaded remaining account on failure
+        tried_accounts = list(exclude)
+        while True:
+            session_id = slot.sessions.take()
+            if session_id:
+                if slot.sessions.needs_refill():
+                    session_refill_wanted.set()
+                break
+            if slot.client.ensure_signed_in():
+                session_id = slot.client.create_session()
+            if session_id:
+                session_refill_wanted.set()
+                break
+            tried_accounts.append(slot.index)
+            account_pool.release(slot, ok=False)
+            if len(set(tried_accounts)) >= len(account_pool.slots):
+                return None, ({"error": "Failed to create session with any account"}, 500)
+            logger.warning("Failed to create new session on account %d. Switching to next account.", tried_accounts[-1])
+            slot = account_pool.acquire(exclude=tried_accounts)
+        logger.info("New session assigned", extra={"fields": {
+            "client": client_id, "account": slot.index, "session": session_id}})
+
+    # Update last interaction time
+    if sticky:
+        CLIENT_SESSIONS.put(client_id, session_id, slot.index)
+    return (slot, session_id), None
+
+
+class RetryPolicy:
+    """Backoff schedule and deadline budget for the upstream attempts of one request."""
+
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BACKOFF_BASE_SECONDS,
+                 max_delay: float = RETRY_BACKOFF_MAX_SECONDS, deadline: float = REQUEST_DEADLINE_SECONDS):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline_at = time.monotonic() + deadline
+
+    def remaining(self) -> float:
+        return self.deadline_at - time.monotonic()
+
+    def backoff(self, failed_attempts: int) -> Optional[float]:
+        """Delay before the next attempt, or None when attempts or the deadline are used up."""
+        if failed_attempts >= self.max_attempts:
+            return None
+        # Full jitter keeps retries from many requests failing at once from arriving together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (failed_attempts - 1)))
+        return delay if delay < self.remaining() else None
+
+
+class UpstreamAttempt:
+    """One lease + query against upstream. A successful attempt still holds its account lease."""
+    __slots__ = ("slot", "session_id", "result")
+
+    def __init__(self, slot: Optional[AccountSlot], session_id: Optional[str], result: Dict):
+        self.slot = slot
+        self.session_id = session_id
+        self.result = result
+
+    @property
+    def ok(self) -> bool:
+        return "error" not in self.result
+
+    @property
+    def retryable(self) -> bool:
+        return self.result.get("retryable", True)
+
+
+# Runs the competing attempts of hedged streaming queries in Flask mode; created by initialize()
+_attempt_executor: ThreadPoolExecutor
+
+
+def _attempt_timeout(slot: AccountSlot, session_id: str, stream: bool, policy: Optional[RetryPolicy]
+                     ) -> Tuple[Optional[float], Optional[UpstreamAttempt]]:
+    """How long a streaming attempt may wait for response headers: the read timeout, cut to the
+    request's remaining deadline. Returns (timeout, None), or (None, failed attempt) once the
+    deadline has passed, in which case the lease has been given back. Non-streaming queries keep
+    UPSTREAM_READ_TIMEOUT (None): their headers only arrive with the finished answer."""
+    if policy is None or not stream:
+        return None, None
+    remaining = policy.remaining()
+    if remaining <= 0:
+        account_pool.release(slot, ok=None)
+        return None, UpstreamAttempt(slot, session_id, {"error": "Request deadline exceeded", "retryable": False})
+    return min(UPSTREAM_READ_TIMEOUT, remaining), None
+
+
+def _open_attempt(chat: Dict, client_id: str, stream: bool, tried: List[int],
+                  cancellation: Optional[Cancellation] = None, policy: Optional[RetryPolicy] = None
+                  ) -> UpstreamAttempt:
+    """Lease a session and send the query, waiting for headers no longer than ``policy`` allows.
+    The leased account is appended to ``tried``; a failed attempt has already given its lease back."""
+    lease, error = lease_client_session(client_id, tried, chat["sticky_session"], chat["new_session"])
+    if error:
+        return UpstreamAttempt(None, None, {"error": error[0]["error"]})
+    slot, session_id = lease
+    tried.append(slot.index)
+    if cancellation is not None and cancellation.cancelled:
+        account_pool.release(slot, ok=None)  # The client left while the session was being leased
+        return UpstreamAttempt(slot, session_id, cancelled_result())
+    timeout, expired = _attempt_timeout(slot, session_id, stream, policy)
+    if expired:
+        return expired
+    try:
+        result = slot.client.send_query(chat["query"], endpoint_id=chat["endpoint_id"], stream=stream,
+                                        session_id=session_id, cancellation=cancellation,
+                                        options=chat["upstream_options"], timeout=timeout)
+    except Exception:
+        account_pool.release(slot, ok=False)
+        raise
+    if "error" in result:
+        # A client hanging up says nothing about the account's health
+        account_pool.release(slot, ok=None if result.get("cancelled") else False)
+    return UpstreamAttempt(slot, session_id, result)
+
+
+async def _aopen_attempt(chat: Dict, client_id: str, stream: bool, tried: List[int],
+                         policy: Optional[RetryPolicy] = None) -> UpstreamAttempt:
+    """Asyncio counterpart of _open_attempt; cancelling it (client disconnect) returns the lease."""
+    leasing = asyncio.ensure_future(asyncio.to_thread(lease_client_session, client_id, tried, chat["sticky_session"],
+                                                      chat["new_session"]))
+    try:
+        lease, error = await asyncio.shield(leasing)
+    except asyncio.CancelledError:
+        # The lease is still being taken in a worker thread; hand it back once it arrives
+        leasing.add_done_callback(_release_abandoned_lease)
+        raise
+    if error:
+        return UpstreamAttempt(None, None, {"error": error[0]["error"]})
+    slot, session_id = lease
+    tried.append(slot.index)
+    timeout, expired = _attempt_timeout(slot, session_id, stream, policy)
+    if expired:
+        return expired
+    try:
+        result = await slot.client.async_send_query(chat["query"], endpoint_id=chat["endpoint_id"], stream=stream,
+                                                    session_id=session_id, options=chat["upstream_options"],
+                                                    timeout=timeout)
+    except asyncio.CancelledError:
+        account_pool.release(slot, ok=None)  # A client hanging up says nothing about the account's health
+        raise
+    except Exception:
+        account_pool.release(slot, ok=False)
+        raise
+    if "error" in result:
+        account_pool.release(slot, ok=False)
+    return UpstreamAttempt(slot, session_id, result)
+
+
+def _release_abandoned_lease(leasing: asyncio.Future):
+    if not leasing.cancelled() and leasing.exception() is None:
+        lease, _ = leasing.result()
+        if lease:
+            account_pool.release(lease[0], ok=None)
+
+
+def _discard_attempt(attempt: UpstreamAttempt):
+    """Drop the losing attempt of a hedged query: close its stream and return its lease."""
+    if attempt.ok:
+        attempt.result["response"].close()
+        account_pool.release(attempt.slot)
+
+
+def _hedged_attempt(chat: Dict, client_id: str, tried: List[int], policy: RetryPolicy,
+                    cancellation: Optional[Cancellation] = None) -> UpstreamAttempt:
+    """Open a streaming query, racing a second account against it if it is slow to respond."""
+    primary = _attempt_executor.submit(_open_attempt, chat, client_id, True, tried, cancellation, policy)
+    try:
+        return primary.result(timeout=max(0.0, min(HEDGE_AFTER_SECONDS, policy.remaining())))
+    except FutureTimeoutError:
+        pass
+    hedge_admitted_at = admission.try_admit() if policy.remaining() > 0 else None
+    if hedge_admitted_at is None:
+        return primary.result()
+    hedge = _attempt_executor.submit(_open_attempt, chat, client_id, True, tried, cancellation, policy)
+    pending = {primary, hedge}
+    winner = attempt = None
+    try:
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                attempt = future.result()
+                if attempt.ok and winner is None:
+                    winner = attempt
+                    HEDGED_REQUESTS_TOTAL.inc(winner="primary" if future is primary else "hedge")
+                elif attempt.ok:
+                    _discard_attempt(attempt)  # both finished together
+        return winner or attempt  # when both failed, report the last failure
+    finally:
+        admission.release(hedge_admitted_at)
+        for future in pending:
+            future.add_done_callback(lambda f: f.exception() is None and _discard_attempt(f.result()))
+
+
+async def _ahedged_attempt(chat: Dict, client_id: str, tried: List[int], policy: RetryPolicy) -> UpstreamAttempt:
+    """Asyncio counterpart of _hedged_attempt."""
+    primary = asyncio.ensure_future(_aopen_attempt(chat, client_id, True, tried, policy))
+    pending = {primary}
+    winner = attempt = None
+    hedge_admitted_at = None
+    try:
+        done, pending = await asyncio.wait(pending, timeout=max(0.0, min(HEDGE_AFTER_SECONDS, policy.remaining())))
+        if done:
+            winner = primary.result()
+            return winner
+        hedge_admitted_at = admission.try_admit() if policy.remaining() > 0 else None
+        if hedge_admitted_at is None:
+            winner = await asyncio.shield(primary)
+            pending = set()
+            return winner
+        hedge = asyncio.ensure_future(_aopen_attempt(chat, client_id, True, tried, policy))
+        pending = {primary, hedge}
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                attempt = task.result()
+                if attempt.ok and winner is None:
+                    winner = attempt
+                    HEDGED_REQUESTS_TOTAL.inc(winner="primary" if task is primary else "hedge")
+                elif attempt.ok:
+                    _adiscard_attempt(attempt)  # both finished together
+        return winner or attempt
+    finally:
+        if hedge_admitted_at is not None:
+            admission.release(hedge_admitted_at)
+        # Attempts still running (or abandoned by a cancelled request) clean up when they finish
+        for task in pending:
+            task.add_done_callback(lambda t: not t.cancelled() and t.exception() is None
+                                   and _adiscard_attempt(t.result()))
+
+
+def _adiscard_attempt(attempt: UpstreamAttempt):
+    if attempt.ok:
+        asyncio.ensure_future(attempt.result["response"].aclose())
+        account_pool.release(attempt.slot)
+
+
+def _log_retry(attempt: UpstreamAttempt, failures: int, delay: float):
+    account = attempt.slot.index if attempt.slot is not None else None
+    UPSTREAM_RETRIES_TOTAL.inc(account=str(account) if account is not None else "none")
+    logger.warning("Upstream attempt %d failed on account %s (%s). Retrying in %.2fs.",
+                   failures, account, attempt.result["error"], delay)
+
+
+def open_upstream(chat: Dict, client_id: str, stream: bool, cancellation: Optional[Cancellation] = None
+                  ) -> UpstreamAttempt:
+    """Query upstream with failover: failed attempts are retried on other accounts with backoff
+    while nothing has been sent to the client. The returned successful attempt holds an account
+    lease the caller must release."""
+    policy = RetryPolicy()
+    tried = []
+    failures = 0
+    while True:
+        if cancellation is not None and cancellation.cancelled:
+            attempt = UpstreamAttempt(None, None, cancelled_result())
+            break
+        if stream and HEDGE_AFTER_SECONDS > 0:
+            attempt = _hedged_attempt(chat, client_id, tried, policy, cancellation)
+        else:
+            attempt = _open_attempt(chat, client_id, stream, tried, cancellation, policy)
+        if attempt.ok or not attempt.retryable or (cancellation is not None and cancellation.cancelled):
+            break
+        failures += 1
+        delay = policy.backoff(failures)
+        if delay is None:
+            break
+        _log_retry(attempt, failures, delay)
+        time.sleep(delay)
+    if attempt.ok and len(tried) > 1 and chat["sticky_session"]:
+        # A retry or hedge leased other accounts too; make sure the client sticks to the winner
+        CLIENT_SESSIONS.put(client_id, attempt.session_id, attempt.slot.index)
+    return attempt
+
+
+async def aopen_upstream(chat: Dict, client_id: str, stream: bool) -> UpstreamAttempt:
+    """Asyncio counterpart of open_upstream."""
+    policy = RetryPolicy()
+    tried = []
+    failures = 0
+    while True:
+        if stream and HEDGE_AFTER_SECONDS > 0:
+            attempt = await _ahedged_attempt(chat, client_id, tried, policy)
+        else:
+            attempt = await _aopen_attempt(chat, client_id, stream, tried, policy)
+        if attempt.ok or not attempt.retryable:
+            break
+        failures += 1
+        delay = policy.backoff(failures)
+        if delay is None:
+            break
+        _log_retry(attempt, failures, delay)
+        await asyncio.sleep(delay)
+    if attempt.ok and len(tried) > 1 and chat["sticky_session"]:
+        # The SQLite backend blocks, so the store is updated off the event loop
+        await asyncio.to_thread(CLIENT_SESSIONS.put, client_id, attempt.session_id, attempt.slot.index)
+    return attempt
+
+
+def rejected_result(rejection: Tuple[Dict, int, Dict[str, str]]) -> Dict:
+    """Result dict for a request turned away by admission control."""
+    body, status, headers = rejection
+    return {"error": body["error"], "status": status, "headers": headers}
+
+
+def complete_chat(chat: Dict, client_id: str, metrics: ChatRequestMetrics,
+                  cancellation: Optional[Cancellation] = None) -> Dict:
+    """Run a non-streaming query end to end: admit, query upstream with failover, release."""
+    admitted_at, rejection = admission.admit(client_id, cancellation)
+    if rejection:
+        return cancelled_result() if cancellation is not None and cancellation.cancelled else rejected_result(rejection)
+    try:
+        attempt = open_upstream(chat, client_id, stream=False, cancellation=cancellation)
+        if attempt.slot is not None:
+            metrics.account = str(attempt.slot.index)
+        if attempt.ok:
+            account_pool.release(attempt.slot)
+            metrics.upstream_responded(attempt.result["ttfb"])
+        return attempt.result
+    finally:
+        admission.release(admitted_at)
+
+
+async def acomplete_chat(chat: Dict, client_id: str, metrics: ChatRequestMetrics) -> Dict:
+    """Asyncio counterpart of complete_chat."""
+    admitted_at, rejection = await admission.aadmit(client_id)
+    if rejection:
+        return rejected_result(rejection)
+    try:
+        attempt = await aopen_upstream(chat, client_id, stream=False)
+        if attempt.slot is not None:
+            metrics.account = str(attempt.slot.index)
+        if attempt.ok:
+            account_pool.release(attempt.slot)
+            metrics.upstream_responded(attempt.result["ttfb"])
+        return attempt.result
+    finally:
+        admission.release(admitted_at)
+
+
+def build_chat_completion(model: str, content: str, prompt_tokens: int = 0) -> Dict:
+    """Build a non-streaming OpenAI chat completion response (token counts are estimates)."""
+    completion_tokens = approx_tokens(content)
+    return {
+        "id": new_completion_id(),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "message": {
+                    "role": "assistant",
+                    "content": content
+                },
+                "finish_reason": "stop",
+                "index": 0
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+
+def chat_completions():
+    from flask import request
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return {"error": "Request body must be a JSON object"}, 400
+
+    # Extract client ID (use IP address as a simple identifier for different clients)
+    client_id = request.remote_addr  # Alternatively, use a unique ID from request if provided by Cherry Studio
+    metrics = ChatRequestMetrics("stream" if data.get("stream") else "sync")
+    try:
+        return _chat_completion_response(request, data, client_id, metrics)
+    except Exception:
+        metrics.finish("error")  # No-op when the request already recorded its outcome
+        raise
+
+
+def _chat_completion_response(request, data: Dict, client_id: str, metrics: ChatRequestMetrics):
+    from flask import Response, stream_with_context
+    chat, error = parse_chat_request(data, client_id)
+    if error:
+        metrics.finish("bad_request")
+        return error
+    model = chat["model"]
+    metrics.model = chat["model_label"]
+
+    client_socket = DisconnectWatcher.client_socket(request.environ)
+    if not chat["stream"]:
+        headers = {}
+        if chat["cache_key"] is not None:
+            # The answer is still worth caching if this client leaves, so it is not cancelled
+            result, headers["X-Cache"] = response_cache.get_or_compute(
+                chat["cache_key"], lambda: complete_chat(chat, client_id, metrics),
+                request.headers.get("Cache-Control", ""))
+        else:
+            cancellation = Cancellation()
+            disconnect_watcher.watch(client_socket, cancellation.cancel)
+            try:
+                result = complete_chat(chat, client_id, metrics, cancellation)
+            finally:
+                disconnect_watcher.unwatch(client_socket)
+        if result.get("cancelled"):
+            CLIENT_CANCELLATIONS_TOTAL.inc(mode="sync")
+            metrics.finish("cancelled")
+            return {"error": result["error"]}, 499
+        if "error" in result:
+            metrics.finish("rejected" if "status" in result else "error")
+            return {"error": result["error"]}, result.get("status", 500), result.get("headers", {})
+        metrics.finish("ok")
+        return build_chat_completion(model, result["content"], chat["prompt_tokens"]), 200, headers
+
+    # From here on a client hang-up gives up its queue place, or aborts the upstream response
+    # instead of letting it run to the end
+    cancellation = Cancellation()
+    disconnect_watcher.watch(client_socket, cancellation.cancel)
+    admitted_at, rejection = admission.admit(client_id, cancellation)
+    if rejection:
+        disconnect_watcher.unwatch(client_socket)
+        if cancellation.cancelled:
+            CLIENT_CANCELLATIONS_TOTAL.inc(mode="stream")
+            metrics.finish("cancelled")
+        else:
+            metrics.finish("rejected")
+        return rejection
+
+    # Send query to OnDemand API, failing over to other accounts until it responds
+    try:
+        attempt = open_upstream(chat, client_id, stream=True, cancellation=cancellation)
+    except Exception:
+        disconnect_watcher.unwatch(client_socket)
+        admission.release(admitted_at)
+        metrics.finish("error")
+        raise
+    if attempt.slot is not None:
+        metrics.account = str(attempt.slot.index)
+    if not attempt.ok:
+        disconnect_watcher.unwatch(client_socket)
+        admission.release(admitted_at)
+        if attempt.result.get("cancelled"):
+            CLIENT_CANCELLATIONS_TOTAL.inc(mode="stream")
+            metrics.finish("cancelled")
+            return {"error": attempt.result["error"]}, 499
+        metrics.finish("error")
+        return {"error": attempt.result["error"]}, 500
+    slot, result = attempt.slot, attempt.result
+    metrics.upstream_responded(result["ttfb"])
+    status = "cancelled"  # unless the stream runs to its end (or upstream fails)
+
+    def generate_stream():
+        nonlocal status
+        translator = StreamTranslator(model, usage_prompt_tokens=chat["prompt_tokens"] if chat["include_usage"] else None)
+        try:
+            for data in result["response"].iter_content(chunk_size=STREAM_READ_CHUNK_SIZE):
+                events = translator.feed(data)
+                if events:
+                    metrics.first_chunk()
+                    yield b"".join(events)
+                if translator.done:
+                    status = "ok"
+                    return
+        except requests.exceptions.RequestException:
+            if cancellation.cancelled:
+                return  # Aborted because the client hung up
+            status = "error"
+            ERRORS_TOTAL.inc(kind="stream", account=metrics.account)
+            raise
+        if cancellation.cancelled:
+            return  # The aborted upstream body ended early; the stream is incomplete
+        yield b"".join(translator.finish())
+        status = "ok"
+
+    def on_close():
+        disconnect_watcher.unwatch(client_socket)
+        if status == "cancelled":
+            # The client went away mid-stream: stop upstream generating tokens nobody reads
+            cancellation.cancel()
+            CLIENT_CANCELLATIONS_TOTAL.inc(mode="stream")
+        account_pool.release(slot, ok=None if status == "cancelled" else status == "ok")
+        admission.release(admitted_at)
+        metrics.finish(status)
+
+    response = Response(stream_with_context(generate_stream()), content_type='text/event-stream')
+    # Keep the account and upstream slot until the stream has been fully sent (or abandoned)
+    response.call_on_close(on_close)
+    return response
+
+
+def metrics_endpoint():
+    from flask import Response
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+
+def healthz():
+    return readiness()
+
+
+def create_app() -> "Flask":
+    """Build the Flask (WSGI) app, e.g. ``gunicorn '2api:create_app()'``.
+
+    Flask is only imported here, so the ASGI serving mode never loads it.
+    """
+    from flask import Flask
+    initialize()
+    flask_app = Flask(__name__)
+    flask_app.before_request(ensure_background_tasks)
+    flask_app.add_url_rule('/v1/models', view_func=get_models, methods=['GET'])
+    flask_app.add_url_rule('/v1/chat/completions', view_func=chat_completions, methods=['POST'])
+    flask_app.add_url_rule('/metrics', view_func=metrics_endpoint, methods=['GET'])
+    flask_app.add_url_rule('/healthz', view_func=healthz, methods=['GET'])
+    return flask_app
+
+
+# ---------------------------------------------------------------------------
+# ASGI (asyncio) serving mode
+# ---------------------------------------------------------------------------
+# Serves the same /v1/models and /v1/chat/completions contract as the Flask app,
+# but upstream queries run on an asyncio client so an open SSE stream costs a
+# coroutine instead of a worker thread. Session bookkeeping (sign in, session
+# creation) is still synchronous and is pushed to the default thread pool.
+
+async def _asgi_read_body(receive) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def _asgi_send_json(send, payload: Dict, status: int = 200, headers: Optional[Dict[str, str]] = None):
+    body = json.dumps(payload).encode("utf-8")
+    response_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    response_headers.extend((name.lower().encode("latin-1"), value.encode("latin-1"))
+                            for name, value in (headers or {}).items())
+    await send({"type": "http.response.start", "status": status, "headers": response_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _asgi_chat_completions(scope, receive, send):
+    try:
+        data = json.loads(await _asgi_read_body(receive) or b"null")
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        await _asgi_send_json(send, {"error": "Request body must be a JSON object"}, 400)
+        return
+
+    client = scope.get("client")
+    client_id = client[0] if client else "unknown"
+    metrics = ChatRequestMetrics("stream" if data.get("stream") else "sync")
+    status = "error"
+    try:
+        chat, error = parse_chat_request(data, client_id)
+        if error:
+            status = "bad_request"
+            await _asgi_send_json(send, error[0], error[1])
+            return
+        model = chat["model"]
+        metrics.model = chat["model_label"]
+
+        if not chat["stream"]:
+            headers = {}
+            if chat["cache_key"] is not None:
+                # The answer is still worth caching if this client leaves, so it is not cancelled
+                cache_control = dict(scope["headers"]).get(b"cache-control", b"").decode("latin-1")
+                result, headers["X-Cache"] = await response_cache.aget_or_compute(
+                    chat["cache_key"], lambda: acomplete_chat(chat, client_id, metrics), cache_control)
+            else:
+                disconnected, result = await _asgi_until_disconnect(
+                    receive, acomplete_chat(chat, client_id, metrics))
+                if disconnected:
+                    CLIENT_CANCELLATIONS_TOTAL.inc(mode="sync")
+                    status = "cancelled"
+                    return
+            if "error" in result:
+                if "status" in result:
+                    status = "rejected"
+                await _asgi_send_json(send, {"error": result["error"]}, result.get("status", 500),
+                                      result.get("headers"))
+            else:
+                status = "ok"
+                await _asgi_send_json(send, build_chat_completion(model, result["content"], chat["prompt_tokens"]),
+                                      headers=headers)
+            return
+
+        # A client hanging up cancels the whole stream, closing the upstream response with it
+        disconnected, status = await _asgi_until_disconnect(receive, _asgi_stream_chat(send, chat, client_id, metrics))
+        if disconnected:
+            CLIENT_CANCELLATIONS_TOTAL.inc(mode="stream")
+            status = "cancelled"
+    finally:
+        metrics.finish(status)
+
+
+async def _asgi_wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def _asgi_until_disconnect(receive, work) -> Tuple[bool, object]:
+    """Run the ``work`` coroutine, cancelling it if the client disconnects first.
+
+    Returns (disconnected, result of ``work``).
+    """
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(_asgi_wait_disconnect(receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+    try:
+        return False, await task
+    except asyncio.CancelledError:
+        return True, None
+
+
+async def _asgi_stream_chat(send, chat: Dict, client_id: str, metrics: ChatRequestMetrics) -> str:
+    """Admit, open the upstream stream with failover and relay it; returns the request status."""
+    admitted_at, rejection = await admission.aadmit(client_id)
+    if rejection:
+        await _asgi_send_json(send, *rejection)
+        return "rejected"
+    try:
+        attempt = await aopen_upstream(chat, client_id, stream=True)
+        if attempt.slot is not None:
+            metrics.account = str(attempt.slot.index)
+        if not attempt.ok:
+            await _asgi_send_json(send, {"error": attempt.result["error"]}, 500)
+            return "error"
+        account_ok = True
+        try:
+            metrics.upstream_responded(attempt.result["ttfb"])
+            if not await _asgi_stream_completion(send, attempt.result["response"], chat, metrics):
+                account_ok = False
+                return "error"
+            return "ok"
+        except asyncio.CancelledError:
+            account_ok = None  # The client went away
+            raise
+        except Exception:
+            account_ok = False
+            raise
+        finally:
+            account_pool.release(attempt.slot, ok=account_ok)
+    finally:
+        admission.release(admitted_at)
+
+
+async def _asgi_stream_completion(send, response, chat: Dict, metrics: ChatRequestMetrics) -> bool:
+    """Relay an upstream stream as OpenAI chunks; False when upstream failed part way through."""
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]
+        })
+        translator = StreamTranslator(chat["model"],
+                                      usage_prompt_tokens=chat["prompt_tokens"] if chat["include_usage"] else None)
+        try:
+            async for data in response.aiter_bytes():
+                events = translator.feed(data)
+                if events:
+                    metrics.first_chunk()
+                    await send({"type": "http.response.body", "body": b"".join(events), "more_body": True})
+                if translator.done:
+                    break
+            else:
+                events = translator.finish()
+                if events:
+                    await send({"type": "http.response.body", "body": b"".join(events), "more_body": True})
+        except httpx.HTTPError as e:
+            # The status line is already sent: end the body so the client sees the stream stop early
+            logger.error("Upstream stream failed on account %s: %s", metrics.account, e)
+            ERRORS_TOTAL.inc(kind="stream", account=metrics.account)
+            await send({"type": "http.response.body", "body": b""})
+            return False
+        await send({"type": "http.response.body", "body": b""})
+        return True
+    finally:
+        await response.aclose()
+
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point (e.g. ``uvicorn 2api:asgi_app``)."""
+    initialize()
+    _import_httpx()
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                install_drain_handler()  # the server's own signal handlers are in place by now
+                start_background_tasks()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                shutdown_event.set()
+                await account_pool.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"]
+    method = scope["method"]
+    if path == "/metrics" and method == "GET":
+        body = render_metrics()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", METRICS_CONTENT_TYPE.encode()), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+    elif path == "/healthz" and method == "GET":
+        body, status = readiness()
+        await _asgi_send_json(send, body, status)
+    elif path == "/v1/models":
+        if method != "GET":
+            await _asgi_send_json(send, {"error": "Method not allowed"}, 405)
+            return
+        catalog = model_registry.current()
+        headers = [(b"etag", catalog.etag.encode()), (b"cache-control", b"no-cache")]
+        if etag_matches(dict(scope["headers"]).get(b"if-none-match", b"").decode("latin-1"), catalog.etag):
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": headers + [(b"content-type", b"application/json"),
+                                          (b"content-length", str(len(catalog.body)).encode())]})
+        await send({"type": "http.response.body", "body": catalog.body})
+    elif path == "/v1/chat/completions":
+        if method != "POST":
+            await _asgi_send_json(send, {"error": "Method not allowed"}, 405)
+            return
+        await _asgi_chat_completions(scope, receive, send)
+    else:
+        await _asgi_send_json(send, {"error": "Not found"}, 404)
+
+
+def run_gunicorn(application, worker_class: str, port: int):
+    """Serve ``application`` under gunicorn: SERVER_WORKERS forked processes sharing the
+    already-loaded module, SIGTERM drains for up to SHUTDOWN_GRACE_SECONDS."""
+    from gunicorn.app.base import BaseApplication
+
+    def post_worker_init(worker):
+        if worker_class == "gthread":
+            # The ASGI worker does this in its lifespan startup instead
+            install_drain_handler()
+            start_background_tasks()
+
+    options = {
+        "bind": f"0.0.0.0:{port}",
+        "workers": SERVER_WORKERS,
+        "threads": SERVER_THREADS,
+        "worker_class": worker_class,
+        "preload_app": True,
+        "graceful_timeout": int(SHUTDOWN_GRACE_SECONDS),
+        "post_worker_init": post_worker_init,
+    }
+
+    class ProxyApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return application
+
+    ProxyApplication().run()
+
+
+if __name__ == "__main__":
+    # Get port from environment variable (Hugging Face Spaces uses PORT env var)
+    port = int(os.getenv("PORT", 7860))
+    # "asgi" serves through uvicorn + httpx, "flask" uses the threaded Flask server,
+    # "auto" picks asgi when its optional dependencies are installed.
+    server_mode = get_setting("server_mode", "auto").lower()
+    initialize()  # fail fast without accounts; with gunicorn this preloads the state workers inherit
+    try:
+        import uvicorn
+    except ImportError:
+        uvicorn = None
+    try:
+        import gunicorn  # Optional: multi-process production server
+    except ImportError:
+        gunicorn = None
+    use_asgi = server_mode != "flask" and uvicorn is not None and importlib.util.find_spec("httpx") is not None
+    if server_mode == "asgi" and not use_asgi:
+        logger.warning("ASGI mode requires the uvicorn and httpx packages. Falling back to Flask.")
+    if gunicorn is not None:
+        logger.info("Starting %s app under gunicorn on port %d with %d workers",
+                    "ASGI" if use_asgi else "Flask", port, SERVER_WORKERS)
+        run_gunicorn(asgi_app if use_asgi else create_app(), "uvicorn.workers.UvicornWorker" if use_asgi else "gthread", port)
+    elif use_asgi:
+        logger.info("Starting ASGI app on port %d with %d workers", port, SERVER_WORKERS)
+        if SERVER_WORKERS > 1:
+            # uvicorn spawns its workers, which import the module again by name
+            uvicorn.run("2api:asgi_app", app_dir=os.path.dirname(os.path.abspath(__file__)), host='0.0.0.0',
+                        port=port, workers=SERVER_WORKERS, timeout_graceful_shutdown=SHUTDOWN_GRACE_SECONDS,
+                        log_level="warning")
+        else:
+            uvicorn.run(asgi_app, host='0.0.0.0', port=port, timeout_graceful_shutdown=SHUTDOWN_GRACE_SECONDS,
+                        log_level="warning")
+    else:
+        if SERVER_WORKERS > 1:
+            logger.warning("SERVER_WORKERS requires gunicorn; the Flask development server runs one process.")
+        install_drain_handler()
+        start_background_tasks()
+        logger.info("Starting Flask app on port %d", port)
+        # Run the Flask app with host 0.0.0.0 to be accessible in Docker
+        create_app().run(host='0.0.0.0', port=port, debug=False)
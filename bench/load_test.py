@@ -0,0 +1,344 @@
+"""Load test for the proxy's /v1/chat/completions endpoint.
+
+Drives a fixed number of concurrent clients against a running proxy (or spawns the mock
+upstream plus a proxy process with --spawn) and reports throughput, time-to-first-byte and
+inter-chunk latency percentiles, errors, and the proxy's CPU time and resident memory (summed
+over its worker processes). Results can be saved as JSON and compared against a previous run
+to catch regressions:
+
+    python bench/load_test.py --spawn --stream --concurrency 32 --duration 30 --save baseline.json
+    python bench/load_test.py --spawn --stream --concurrency 32 --duration 30 --compare baseline.json
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_upstream  # noqa: E402
+
+PROXY_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "2api.py")
+
+# Metric -> True when a larger value is better; used by --compare
+COMPARED_METRICS = {
+    "throughput_rps": True,
+    "ttfb_p50_ms": False,
+    "ttfb_p99_ms": False,
+    "inter_chunk_p50_ms": False,
+    "inter_chunk_p99_ms": False,
+    "error_rate": False,
+    "cpu_seconds_per_request": False,
+    "rss_peak_mb": False,
+}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def process_tree(pid: int) -> List[int]:
+    """``pid`` and all its descendants (e.g. a gunicorn master and its workers), from /proc."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, ()))
+    return tree
+
+
+def read_process_usage(pid: int) -> Optional[Dict[str, float]]:
+    """CPU seconds (user+system) and RSS/peak RSS in MB of a local process and its descendants,
+    summed, from /proc. Worker processes that exit during the run are not counted."""
+    ticks = os.sysconf("SC_CLK_TCK")
+    usage = {"cpu_seconds": 0.0, "rss_mb": 0.0, "rss_peak_mb": 0.0, "processes": 0}
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{member}/status") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        usage["cpu_seconds"] += (int(fields[11]) + int(fields[12])) / ticks
+        usage["rss_mb"] += int(status.get("VmRSS", "0 kB").split()[0]) / 1024.0
+        usage["rss_peak_mb"] += int(status.get("VmHWM", "0 kB").split()[0]) / 1024.0
+        usage["processes"] += 1
+    return usage if usage["processes"] else None
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.errors = 0
+        self.error_samples: Dict[str, int] = {}
+        self.ttfb: List[float] = []
+        self.inter_chunk: List[float] = []
+        self.durations: List[float] = []
+
+    def record(self, ttfb: float, gaps: List[float], duration: float):
+        with self.lock:
+            self.completed += 1
+            self.ttfb.append(ttfb)
+            self.inter_chunk.extend(gaps)
+            self.durations.append(duration)
+
+    def record_error(self, reason: str):
+        with self.lock:
+            self.errors += 1
+            self.error_samples[reason] = self.error_samples.get(reason, 0) + 1
+
+
+def run_one(conn: http.client.HTTPConnection, path: str, body: bytes, stream: bool, results: Results) -> bool:
+    """Send one completion request over a keep-alive connection; False means reconnect."""
+    started = time.perf_counter()
+    try:
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        if response.status != 200:
+            response.read()
+            results.record_error(f"HTTP {response.status}")
+            return True
+        ttfb = None
+        gaps = []
+        last = None
+        if stream:
+            while True:
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                now = time.perf_counter()
+                if ttfb is None:
+                    ttfb = now - started
+                else:
+                    gaps.append(now - last)
+                last = now
+        else:
+            response.read(1)
+            ttfb = time.perf_counter() - started
+            response.read()
+        results.record(ttfb or 0.0, gaps, time.perf_counter() - started)
+        return not response.will_close
+    except (OSError, http.client.HTTPException) as e:
+        results.record_error(type(e).__name__)
+        return False
+
+
+def worker(url: str, body: bytes, stream: bool, deadline: float, remaining: List[int],
+           remaining_lock: threading.Lock, results: Results, timeout: float):
+    parts = urlsplit(url)
+    conn = None
+    while time.perf_counter() < deadline:
+        with remaining_lock:
+            if remaining[0] == 0:
+                break
+            remaining[0] -= 1
+        if conn is None:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+        if not run_one(conn, parts.path or "/", body, stream, results):
+            conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+
+
+def run_load(url: str, concurrency: int, total_requests: int, duration: float, stream: bool, model: str,
+             prompt: str, timeout: float, proxy_pid: Optional[int]) -> dict:
+    body = json.dumps({"model": model, "stream": stream,
+                       "messages": [{"role": "user", "content": prompt}]}).encode("utf-8")
+    results = Results()
+    remaining = [total_requests if total_requests > 0 else -1]
+    remaining_lock = threading.Lock()
+    usage_before = read_process_usage(proxy_pid) if proxy_pid else None
+    started = time.perf_counter()
+    deadline = started + duration if duration > 0 else float("inf")
+    threads = [threading.Thread(target=worker, daemon=True,
+                                args=(url, body, stream, deadline, remaining, remaining_lock, results, timeout))
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    usage_after = read_process_usage(proxy_pid) if proxy_pid else None
+
+    attempted = results.completed + results.errors
+    report = {
+        "url": url,
+        "stream": stream,
+        "concurrency": concurrency,
+        "elapsed_seconds": round(elapsed, 3),
+        "requests": attempted,
+        "completed": results.completed,
+        "errors": results.errors,
+        "error_breakdown": results.error_samples,
+        "error_rate": round(results.errors / attempted, 4) if attempted else 0.0,
+        "throughput_rps": round(results.completed / elapsed, 2) if elapsed else 0.0,
+        "ttfb_p50_ms": round(percentile(results.ttfb, 50) * 1000, 2),
+        "ttfb_p99_ms": round(percentile(results.ttfb, 99) * 1000, 2),
+        "duration_p50_ms": round(percentile(results.durations, 50) * 1000, 2),
+        "duration_p99_ms": round(percentile(results.durations, 99) * 1000, 2),
+        "inter_chunk_p50_ms": round(percentile(results.inter_chunk, 50) * 1000, 2),
+        "inter_chunk_p99_ms": round(percentile(results.inter_chunk, 99) * 1000, 2),
+    }
+    if usage_before and usage_after:
+        cpu = usage_after["cpu_seconds"] - usage_before["cpu_seconds"]
+        report["cpu_seconds"] = round(cpu, 3)
+        report["cpu_seconds_per_request"] = round(cpu / results.completed, 6) if results.completed else 0.0
+        report["rss_mb"] = round(usage_after["rss_mb"], 1)
+        report["rss_peak_mb"] = round(usage_after["rss_peak_mb"], 1)
+        report["proxy_processes"] = usage_after["processes"]
+    return report
+
+
+def compare(report: dict, baseline: dict, tolerance: float, metrics: Dict[str, bool] = COMPARED_METRICS) -> List[str]:
+    """Metrics that got worse than the baseline by more than `tolerance` (a fraction)."""
+    regressions = []
+    for name, higher_is_better in metrics.items():
+        if name not in report or name not in baseline:
+            continue
+        current, previous = report[name], baseline[name]
+        if higher_is_better:
+            worse = current < previous * (1 - tolerance)
+        else:
+            # Small absolute values (e.g. 0 errors, sub-ms gaps) get a floor so noise is not a regression
+            worse = current > max(previous * (1 + tolerance), previous + 0.001)
+        if worse:
+            regressions.append(f"{name}: {previous} -> {current}")
+    return regressions
+
+
+def wait_for_proxy(url: str, process: subprocess.Popen, timeout: float = 30.0):
+    parts = urlsplit(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Proxy exited with code {process.returncode} during startup")
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=2)
+            conn.request("GET", "/v1/models")
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+            conn.close()
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Proxy did not become ready in time")
+
+
+def spawn_stack(args: argparse.Namespace):
+    """Start the mock upstream in-process and the proxy as a subprocess pointed at it."""
+    server = mock_upstream.create_server("127.0.0.1", args.mock_port, mock_upstream.MockConfig.from_args(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mock_url = f"http://127.0.0.1:{server.server_address[1]}"
+    accounts = [{"email": f"bench{i}@example.com", "password": "bench"} for i in range(args.accounts)]
+    env = dict(os.environ,
+               ONDEMAND_ACCOUNTS=json.dumps({"accounts": accounts}),
+               ONDEMAND_BASE_URL=f"{mock_url}/v1",
+               ONDEMAND_CHAT_BASE_URL=f"{mock_url}/chat/v1/client",
+               PORT=str(args.proxy_port),
+               SERVER_MODE=args.server_mode,
+               LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"))
+    output = None if args.verbose else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, PROXY_SCRIPT], env=env, stdout=output, stderr=output)
+    url = f"http://127.0.0.1:{args.proxy_port}/v1/chat/completions"
+    try:
+        wait_for_proxy(url, process)
+    except RuntimeError:
+        process.terminate()
+        server.shutdown()
+        raise
+    return server, process, url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://127.0.0.1:7860/v1/chat/completions")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=0, help="total requests (0 = until --duration elapses)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run (0 = until --requests are sent)")
+    parser.add_argument("--stream", action="store_true", help="request streaming completions")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--prompt", default="Say hello.")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--proxy-pid", type=int, help="pid of a local proxy to sample CPU and RSS from (its worker processes included)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--save", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON report; exit 1 if a metric regressed")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed regression vs. the baseline")
+    spawn = parser.add_argument_group("spawned stack (--spawn)")
+    spawn.add_argument("--spawn", action="store_true", help="start the mock upstream and a proxy process")
+    spawn.add_argument("--mock-port", type=int, default=0, help="mock upstream port (0 = any free port)")
+    spawn.add_argument("--proxy-port", type=int, default=18790)
+    spawn.add_argument("--server-mode", default="auto", choices=["auto", "asgi", "flask"])
+    spawn.add_argument("--accounts", type=int, default=4, help="fake accounts given to the proxy")
+    spawn.add_argument("--verbose", action="store_true", help="show the proxy's own output")
+    mock_upstream.add_arguments(spawn)
+    args = parser.parse_args()
+    if args.requests <= 0 and args.duration <= 0:
+        parser.error("one of --requests or --duration must be positive")
+
+    server = process = None
+    url, proxy_pid = args.url, args.proxy_pid
+    if args.spawn:
+        server, process, url = spawn_stack(args)
+        proxy_pid = process.pid
+    try:
+        report = run_load(url, args.concurrency, args.requests, args.duration, args.stream, args.model,
+                          args.prompt, args.timeout, proxy_pid)
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if server is not None:
+            server.shutdown()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>24}: {value}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for key in ("stream", "concurrency"):
+            if baseline.get(key) != report[key]:
+                print(f"Warning: baseline was run with {key}={baseline.get(key)}, this run uses {key}={report[key]}")
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
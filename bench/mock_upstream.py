@@ -0,0 +1,222 @@
+"""Local stand-in for the on-demand.io endpoints used by OnDemandAPIClient.
+
+Serves sign-in, token refresh, session creation and session queries (sync and SSE) on one
+port, with configurable latency, token rate, 401 injection and error rate, so the proxy can
+be measured without touching gateway.on-demand.io.
+
+Run it, then point the proxy at it:
+
+    python bench/mock_upstream.py --port 18080 --tokens 200 --token-rate 100
+    ONDEMAND_BASE_URL=http://127.0.0.1:18080/v1 \
+    ONDEMAND_CHAT_BASE_URL=http://127.0.0.1:18080/chat/v1/client \
+    ONDEMAND_ACCOUNTS='{"accounts": [{"email": "bench@example.com", "password": "x"}]}' \
+    python 2api.py
+"""
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SESSION_QUERY_PATH = re.compile(r"^/chat/v1/client/sessions/([^/]+)/query$")
+
+
+class MockConfig:
+    def __init__(self, latency_ms: float = 20.0, ttfb_ms: float = 50.0, tokens: int = 50, token_rate: float = 200.0,
+                 token_text: str = "token ", unauthorized_rate: float = 0.0, error_rate: float = 0.0,
+                 token_ttl: float = 3600.0):
+        self.latency_ms = latency_ms  # added to every control call (sign-in, refresh, sessions)
+        self.ttfb_ms = ttfb_ms  # delay before a query responds
+        self.tokens = tokens  # fulfillment events per answer
+        self.token_rate = token_rate  # fulfillment events per second (0 = as fast as possible)
+        self.token_text = token_text
+        self.unauthorized_rate = unauthorized_rate  # probability of answering 401 to a valid token
+        self.error_rate = error_rate  # probability of answering 500
+        self.token_ttl = token_ttl  # lifetime of issued tokens, advertised in the JWT "exp" claim
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "MockConfig":
+        return cls(args.latency_ms, args.ttfb_ms, args.tokens, args.token_rate, args.token_text,
+                   args.unauthorized_rate, args.error_rate, args.token_ttl)
+
+
+class MockState:
+    """Issued tokens and request counters, shared by all handler threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = {}  # token -> expiry (epoch seconds)
+        self.counters = {}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def issue_token(self, ttl: float) -> str:
+        expires_at = time.time() + ttl
+        claims = base64.urlsafe_b64encode(json.dumps({"exp": int(expires_at)}).encode()).rstrip(b"=").decode()
+        token = f"eyJhbGciOiJub25lIn0.{claims}.{uuid.uuid4().hex}"
+        with self.lock:
+            self.tokens[token] = expires_at
+        return token
+
+    def token_valid(self, token: str) -> bool:
+        with self.lock:
+            return self.tokens.get(token, 0) > time.time()
+
+
+class MockUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real upstream
+    config = MockConfig()
+    state = MockState()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body or b"{}")
+        except json.JSONDecodeError:
+            return {}
+
+    def _send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _bearer_ok(self) -> bool:
+        token = self.headers.get("Authorization", "")[len("Bearer "):]
+        if not self.state.token_valid(token) or random.random() < self.config.unauthorized_rate:
+            self.state.count("unauthorized")
+            self._send_json({"message": "Unauthorized"}, 401)
+            return False
+        return True
+
+    def _inject_error(self) -> bool:
+        if random.random() < self.config.error_rate:
+            self.state.count("errors")
+            self._send_json({"message": "Injected upstream error"}, 500)
+            return True
+        return False
+
+    def do_GET(self):
+        if self.path == "/stats":
+            with self.state.lock:
+                self._send_json(dict(self.state.counters))
+        else:
+            self._send_json({"message": "Not found"}, 404)
+
+    def do_POST(self):
+        payload = self._read_json()
+        match = SESSION_QUERY_PATH.match(self.path)
+        if match:
+            self._query(match.group(1), payload)
+            return
+        time.sleep(self.config.latency_ms / 1000.0)
+        if self.path == "/v1/auth/user/signin":
+            self.state.count("signin")
+            if self._inject_error():
+                return
+            self._send_json({"data": {
+                "tokenData": {"token": self.state.issue_token(self.config.token_ttl), "refreshToken": uuid.uuid4().hex},
+                "user": {"userId": "mock-user", "default_company_id": "mock-company"}}})
+        elif self.path == "/v1/auth/user/refresh_token":
+            self.state.count("refresh")
+            if self._inject_error():
+                return
+            self._send_json({"data": {"token": self.state.issue_token(self.config.token_ttl),
+                                      "refreshToken": uuid.uuid4().hex}})
+        elif self.path == "/chat/v1/client/sessions":
+            self.state.count("sessions")
+            if not self._bearer_ok() or self._inject_error():
+                return
+            self._send_json({"data": {"id": f"mock-session-{uuid.uuid4().hex[:16]}"}})
+        else:
+            self._send_json({"message": "Not found"}, 404)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _query(self, session_id: str, payload: dict):
+        self.state.count("queries")
+        if not self._bearer_ok() or self._inject_error():
+            return
+        time.sleep(self.config.ttfb_ms / 1000.0)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        interval = 1.0 / self.config.token_rate if self.config.token_rate > 0 else 0.0
+        tokens = self.config.tokens
+        max_tokens = (payload.get("modelConfigs") or {}).get("maxTokens") or 0
+        if max_tokens > 0:
+            tokens = min(tokens, max_tokens)
+        try:
+            # Upstream answers in SSE for both response modes; sync mode just is not read incrementally
+            for _ in range(tokens):
+                event = {"eventType": "fulfillment", "answer": self.config.token_text, "sessionId": session_id}
+                self._write_chunk(b"data:" + json.dumps(event).encode("utf-8") + b"\n\n")
+                if interval:
+                    time.sleep(interval)
+            self._write_chunk(b'data:{"eventType":"metricsLog","publicMetrics":{}}\n\n')
+            self._write_chunk(b"data:[DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            self.state.count("client_disconnects")
+            self.close_connection = True
+
+
+class MockUpstreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # Clients dropping keep-alive connections (e.g. a proxy shutting down) are expected
+
+
+def create_server(host: str, port: int, config: MockConfig) -> ThreadingHTTPServer:
+    """Build a mock upstream server; call serve_forever() (e.g. in a thread) to run it."""
+    handler = type("ConfiguredMockUpstreamHandler", (MockUpstreamHandler,), {"config": config, "state": MockState()})
+    server = MockUpstreamServer((host, port), handler)
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="delay of sign-in/refresh/session calls")
+    parser.add_argument("--ttfb-ms", type=float, default=50.0, help="delay before a query starts answering")
+    parser.add_argument("--tokens", type=int, default=50, help="fulfillment events per answer")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="fulfillment events per second (0 = unthrottled)")
+    parser.add_argument("--token-text", default="token ", help="text of each fulfillment event")
+    parser.add_argument("--unauthorized-rate", type=float, default=0.0, help="probability of a 401 on a valid token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 500 response")
+    parser.add_argument("--token-ttl", type=float, default=3600.0, help="lifetime of issued tokens in seconds")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = create_server(args.host, args.port, MockConfig.from_args(args))
+    print(f"Mock on-demand upstream listening on http://{args.host}:{args.port}")
+    print(f"  ONDEMAND_BASE_URL=http://{args.host}:{args.port}/v1")
+    print(f"  ONDEMAND_CHAT_BASE_URL=http://{args.host}:{args.port}/chat/v1/client")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
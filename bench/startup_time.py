@@ -0,0 +1,162 @@
+"""Cold-start benchmark for the proxy: import time and time to the first successful completion.
+
+Each run starts a fresh interpreter, so nothing is cached between runs. The import is
+measured in a separate process without any accounts configured (importing must not need
+them). The proxy is then started against the local mock upstream, and the benchmark times
+how long it takes to accept connections and to answer its first chat completion. Medians
+over the runs can be saved and compared like the load test's reports:
+
+    python bench/startup_time.py --runs 5 --save startup.json
+    python bench/startup_time.py --runs 5 --compare startup.json
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_upstream  # noqa: E402
+from load_test import PROXY_SCRIPT, compare  # noqa: E402
+
+# Metric -> True when a larger value is better; used by --compare
+COMPARED_METRICS = {
+    "import_ms": False,
+    "listening_ms": False,
+    "first_completion_ms": False,
+}
+
+IMPORT_SNIPPET = """
+import importlib.util, sys, time
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location("proxy", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print((time.perf_counter() - started) * 1000)
+"""
+
+
+def measure_import(env: Dict[str, str]) -> float:
+    """Milliseconds to import 2api.py in a fresh interpreter with no accounts configured."""
+    env = {key: value for key, value in env.items() if key != "ONDEMAND_ACCOUNTS"}
+    output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET, PROXY_SCRIPT], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def try_completion(port: int, body: bytes) -> Optional[int]:
+    """Status of one chat completion, or None while the proxy is not accepting connections."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("POST", "/v1/chat/completions", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    except OSError:
+        return None
+    finally:
+        conn.close()
+
+
+def measure_start(env: Dict[str, str], port: int, body: bytes, timeout: float, verbose: bool) -> Dict[str, float]:
+    """Start the proxy and time how long it takes to accept connections and to answer a completion."""
+    output = None if verbose else subprocess.DEVNULL
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, PROXY_SCRIPT], env=env, stdout=output, stderr=output)
+    listening_ms = None
+    try:
+        while time.perf_counter() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"Proxy exited with code {process.returncode} during startup")
+            status = try_completion(port, body)
+            if status is not None and listening_ms is None:
+                listening_ms = (time.perf_counter() - started) * 1000
+            if status == 200:
+                return {"listening_ms": listening_ms, "first_completion_ms": (time.perf_counter() - started) * 1000}
+            time.sleep(0.01)
+        raise RuntimeError("Proxy did not answer a completion in time")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--proxy-port", type=int, default=18791)
+    parser.add_argument("--mock-port", type=int, default=0, help="mock upstream port (0 = any free port)")
+    parser.add_argument("--server-mode", default="auto", choices=["auto", "asgi", "flask"])
+    parser.add_argument("--accounts", type=int, default=4, help="fake accounts given to the proxy")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for the first completion")
+    parser.add_argument("--verbose", action="store_true", help="show the proxy's own output")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--save", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON report; exit 1 if a metric regressed")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed regression vs. the baseline")
+    mock_upstream.add_arguments(parser)
+    # A near-instant answer, so the first completion measures startup rather than generation
+    parser.set_defaults(ttfb_ms=0.0, tokens=1)
+    args = parser.parse_args()
+
+    server = mock_upstream.create_server("127.0.0.1", args.mock_port, mock_upstream.MockConfig.from_args(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mock_url = f"http://127.0.0.1:{server.server_address[1]}"
+    accounts = [{"email": f"bench{i}@example.com", "password": "bench"} for i in range(args.accounts)]
+    env = dict(os.environ,
+               ONDEMAND_ACCOUNTS=json.dumps({"accounts": accounts}),
+               ONDEMAND_BASE_URL=f"{mock_url}/v1",
+               ONDEMAND_CHAT_BASE_URL=f"{mock_url}/chat/v1/client",
+               PORT=str(args.proxy_port),
+               SERVER_MODE=args.server_mode,
+               LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"))
+    body = json.dumps({"model": args.model, "messages": [{"role": "user", "content": "Say hello."}]}).encode("utf-8")
+
+    samples = {name: [] for name in COMPARED_METRICS}
+    try:
+        for _ in range(args.runs):
+            samples["import_ms"].append(measure_import(env))
+            for name, value in measure_start(env, args.proxy_port, body, args.timeout, args.verbose).items():
+                samples[name].append(value)
+    finally:
+        server.shutdown()
+
+    report = {"runs": args.runs, "server_mode": args.server_mode}
+    for name, values in samples.items():
+        report[name] = round(statistics.median(values), 1)
+        report[f"{name}_min"] = round(min(values), 1)
+        report[f"{name}_max"] = round(max(values), 1)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:>24}: {value}")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("server_mode") != report["server_mode"]:
+            print(f"Warning: baseline was run with server_mode={baseline.get('server_mode')}, "
+                  f"this run uses server_mode={report['server_mode']}")
+        regressions = compare(report, baseline, args.tolerance, COMPARED_METRICS)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
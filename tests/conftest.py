@@ -0,0 +1,17 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+PROXY_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "2api.py")
+
+
+@pytest.fixture(scope="session")
+def proxy():
+    """The 2api.py module; importing it needs no accounts and does no I/O beyond reading settings."""
+    spec = importlib.util.spec_from_file_location("ondemand_proxy_under_test", PROXY_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,151 @@
+import threading
+import time
+
+
+def queue_waiter(admission, client_id, granted):
+    waiter, rejection = admission._enter(client_id, lambda: granted.append(client_id))
+    assert waiter is not None and rejection is None
+    return waiter
+
+
+def test_admits_up_to_the_limit_without_queueing(proxy):
+    admission = proxy.AdmissionController(2, max_queue=4, max_queued_per_client=4, queue_timeout=1)
+    first, _ = admission.admit("a")
+    second, _ = admission.admit("b")
+    assert first is not None and second is not None
+    assert admission.stats()["in_flight"] == 2
+    assert admission.try_admit() is None
+    admission.release(first)
+    admission.release(second)
+    assert admission.idle
+
+
+def test_grants_round_robin_across_clients(proxy):
+    admission = proxy.AdmissionController(1, max_queue=10, max_queued_per_client=10, queue_timeout=1)
+    admitted_at, _ = admission.admit("busy")
+    granted = []
+    for client_id in ("a", "a", "a", "b", "c", "b"):
+        queue_waiter(admission, client_id, granted)
+    assert admission.stats()["waiting_clients"] == 3
+    for _ in range(6):
+        admission.release(admitted_at)
+    assert granted == ["a", "b", "c", "a", "b", "a"]
+    admission.release(admitted_at)
+    assert admission.idle
+
+
+def test_rejects_client_over_its_share_with_429(proxy):
+    admission = proxy.AdmissionController(1, max_queue=10, max_queued_per_client=1, queue_timeout=1)
+    admission.admit("busy")
+    queue_waiter(admission, "a", [])
+    admitted_at, (body, status, headers) = admission.admit("a")
+    assert admitted_at is None
+    assert status == 429 and "error" in body
+    assert int(headers["Retry-After"]) >= 1
+
+
+def test_rejects_when_queue_is_full_with_503(proxy):
+    admission = proxy.AdmissionController(1, max_queue=2, max_queued_per_client=2, queue_timeout=1)
+    admission.admit("busy")
+    queue_waiter(admission, "a", [])
+    queue_waiter(admission, "b", [])
+    admitted_at, (body, status, headers) = admission.admit("c")
+    assert admitted_at is None
+    assert status == 503
+    assert int(headers["Retry-After"]) >= 1
+
+
+def test_queue_timeout_abandons_the_waiter(proxy):
+    admission = proxy.AdmissionController(1, max_queue=4, max_queued_per_client=4, queue_timeout=0.05)
+    busy, _ = admission.admit("busy")
+    admitted_at, (body, status, headers) = admission.admit("a")
+    assert admitted_at is None and status == 503 and "Retry-After" in headers
+    assert admission.stats()["queued"] == 0 and admission.stats()["waiting_clients"] == 0
+    # The slot freed later is not handed to the request that gave up
+    admission.release(busy)
+    assert admission.idle
+
+
+def test_queued_request_is_admitted_when_a_slot_frees(proxy):
+    admission = proxy.AdmissionController(1, max_queue=4, max_queued_per_client=4, queue_timeout=5)
+    busy, _ = admission.admit("busy")
+    results = []
+    thread = threading.Thread(target=lambda: results.append(admission.admit("a")))
+    thread.start()
+    while admission.queued == 0:
+        time.sleep(0.001)
+    admission.release(busy)
+    thread.join(timeout=5)
+    admitted_at, rejection = results[0]
+    assert admitted_at is not None and rejection is None
+    assert admission.in_flight == 1
+
+
+def test_draining_rejects_new_requests(proxy):
+    admission = proxy.AdmissionController(1, max_queue=4, max_queued_per_client=4, queue_timeout=1)
+    admission.drain()
+    admitted_at, (body, status, headers) = admission.admit("a")
+    assert admitted_at is None and status == 503
+    assert admission.try_admit() is None
+
+
+def test_limit_follows_capacity(proxy):
+    capacity = [2]
+    admission = proxy.AdmissionController(4, max_queue=4, max_queued_per_client=4, queue_timeout=0.05,
+                                          capacity=lambda: capacity[0])
+    first, _ = admission.admit("a")
+    admission.admit("b")
+    admitted_at, (body, status, headers) = admission.admit("c")
+    assert admitted_at is None and status == 503
+    assert admission.stats()["limit"] == 2
+    capacity[0] = 0  # no limit of its own: the configured one applies
+    assert admission.try_admit() is not None
+    assert admission.stats()["limit"] == 4
+
+
+def test_account_pool_capacity_counts_healthy_accounts(proxy):
+    pool = proxy.AccountPool([{"email": "a@example.com", "password": "x"}, {"email": "b@example.com", "password": "x"}],
+                             max_per_account=3)
+    assert pool.capacity() == 6
+    pool.slots[0].consecutive_failures = proxy.ACCOUNT_FAILURE_THRESHOLD
+    pool.slots[0].unhealthy_until = time.monotonic() + 60
+    assert pool.capacity() == 3
+    pool.slots[0].unhealthy_until = 0.0  # half-open: one trial request
+    assert pool.capacity() == 4
+
+
+def test_account_pool_retries_on_excluded_account_before_exceeding_limit(proxy):
+    pool = proxy.AccountPool([{"email": "a@example.com", "password": "x"}, {"email": "b@example.com", "password": "x"}],
+                             max_per_account=1)
+    first = pool.acquire()
+    slot = pool.acquire(exclude=[1 - first.index])
+    assert slot.index != first.index  # the excluded account is the only one with room
+    assert [s.outstanding for s in pool.slots] == [1, 1]
+
+
+def test_account_pool_keeps_sticky_client_on_busy_account(proxy):
+    pool = proxy.AccountPool([{"email": "a@example.com", "password": "x"}, {"email": "b@example.com", "password": "x"}],
+                             max_per_account=1)
+    assert pool.acquire(preferred=0).index == 0
+    assert pool.acquire(preferred=0).index == 0  # over the limit rather than lose the session
+    assert pool.acquire().index == 1
+    pool.slots[0].unhealthy_until = time.monotonic() + 60
+    assert pool.acquire(preferred=0).index == 1  # only a failing account breaks affinity
+
+
+def test_cancelled_waiter_gives_up_its_place(proxy):
+    admission = proxy.AdmissionController(1, max_queue=4, max_queued_per_client=4, queue_timeout=5)
+    busy, _ = admission.admit("busy")
+    cancellation = proxy.Cancellation()
+    results = []
+    thread = threading.Thread(target=lambda: results.append(admission.admit("a", cancellation)))
+    thread.start()
+    while admission.queued == 0:
+        time.sleep(0.001)
+    cancellation.cancel()
+    thread.join(timeout=1)
+    admitted_at, (body, status, headers) = results[0]
+    assert admitted_at is None and status == 499
+    assert admission.queued == 0
+    admission.release(busy)
+    assert admission.idle
@@ -0,0 +1,43 @@
+import os
+import socket
+import threading
+
+import pytest
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def high_fd_socket(sock: socket.socket, fd: int = 1500) -> socket.socket:
+    """A duplicate of ``sock`` on a file descriptor above select()'s FD_SETSIZE."""
+    os.dup2(sock.fileno(), fd)
+    return socket.socket(fileno=fd)
+
+
+@pytest.mark.skipif(resource is None or resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= 1500,
+                    reason="needs POSIX file descriptors and a higher open files limit")
+def test_hang_up_is_noticed_on_any_file_descriptor(proxy):
+    watcher = proxy.DisconnectWatcher(interval=0.01)
+    server, client = socket.socketpair()
+    watched = high_fd_socket(server)
+    server.close()
+    hung_up = threading.Event()
+    watcher.watch(watched, hung_up.set)
+    assert not hung_up.wait(0.1)  # still connected
+    client.close()
+    assert hung_up.wait(5)
+    watcher.unwatch(watched)
+    watched.close()
+
+
+def test_unwatched_socket_is_left_alone(proxy):
+    watcher = proxy.DisconnectWatcher(interval=0.01)
+    server, client = socket.socketpair()
+    hung_up = threading.Event()
+    watcher.watch(server, hung_up.set)
+    watcher.unwatch(server)
+    client.close()
+    assert not hung_up.wait(0.1)
+    server.close()
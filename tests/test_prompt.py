@@ -0,0 +1,41 @@
+def conversation(*contents):
+    roles = ["system"] + ["user", "assistant"] * len(contents)
+    return [{"role": role, "content": content} for role, content in zip(roles, contents)]
+
+
+def test_continued_conversation_only_renders_new_turns(proxy):
+    cache = proxy.PromptPrefixCache()
+    first = cache.render("client", conversation("Be brief.", "hi"))
+    second = cache.render("client", conversation("Be brief.", "hi", "hello", "how are you?"))
+    assert second.turns[:2] == first.turns
+    assert second.text == "System: Be brief.\n\nUser: hi\n\nAssistant: hello\n\nUser: how are you?\n\n"
+    assert second.tokens == sum(turn.tokens for turn in second.turns)
+    assert cache.render("client", conversation("Be brief.", "hi", "hello", "how are you?")) is second
+
+
+def test_edited_conversation_is_rendered_again(proxy):
+    cache = proxy.PromptPrefixCache()
+    first = cache.render("client", conversation("Be brief.", "hi", "hello", "bye"))
+    edited = cache.render("client", conversation("Be brief.", "hey", "hello"))
+    assert edited.turns[0] is first.turns[0]
+    assert edited.text == "System: Be brief.\n\nUser: hey\n\nAssistant: hello\n\n"
+    assert edited.tokens == sum(turn.tokens for turn in edited.turns)
+
+
+def test_fit_prompt_keeps_system_message_and_recent_turns(proxy):
+    prompt = proxy.RenderedPrompt([proxy.PromptTurn(m["role"], m["content"])
+                                   for m in conversation("Be brief.", "a" * 100, "b" * 100, "c" * 40)])
+    fitted = proxy.fit_prompt(prompt, 50)
+    assert [turn.role for turn in fitted.turns] == ["system", "assistant", "user"]
+    assert fitted.tokens <= 50
+
+
+def test_fit_prompt_cuts_long_latest_message_to_budget(proxy):
+    prompt = proxy.RenderedPrompt([proxy.PromptTurn(m["role"], m["content"])
+                                   for m in conversation("Be brief.", "x" * 400)])
+    fitted = proxy.fit_prompt(prompt, 20)
+    assert [turn.role for turn in fitted.turns] == ["system", "user"]
+    assert fitted.turns[-1].content == "x" * len(fitted.turns[-1].content)
+    assert fitted.tokens <= 20
+    alone = proxy.fit_prompt(proxy.RenderedPrompt(prompt.turns[1:]), 20)
+    assert alone.tokens <= 20 and alone.turns[0].tokens > 10
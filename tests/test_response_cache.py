@@ -0,0 +1,67 @@
+import asyncio
+import os
+import threading
+import time
+
+
+def cache_files(directory):
+    return sorted(name for _, _, names in os.walk(directory) for name in names)
+
+
+def test_expired_disk_entry_is_deleted_on_read(proxy, tmp_path):
+    cache = proxy.ResponseCache(1024 * 1024, ttl=-1, directory=str(tmp_path))
+    cache.put("ab" + "0" * 62, "answer")
+    assert len(cache_files(tmp_path)) == 1
+    # A fresh process has only the disk tier
+    assert proxy.ResponseCache(1024 * 1024, ttl=60, directory=str(tmp_path)).get("ab" + "0" * 62) is None
+    assert cache_files(tmp_path) == []
+
+
+def test_disk_entry_is_shared_between_instances(proxy, tmp_path):
+    proxy.ResponseCache(1024 * 1024, ttl=60, directory=str(tmp_path)).put("cd" + "0" * 62, "answer")
+    assert proxy.ResponseCache(1024 * 1024, ttl=60, directory=str(tmp_path)).get("cd" + "0" * 62) == "answer"
+
+
+def test_async_lookup_keeps_disk_io_off_the_event_loop(proxy, tmp_path):
+    disk_threads = []
+
+    class RecordingCache(proxy.ResponseCache):
+        def _get_disk(self, key):
+            disk_threads.append(threading.get_ident())
+            return super()._get_disk(key)
+
+        def _put_disk(self, key, content, expires_at):
+            disk_threads.append(threading.get_ident())
+            super()._put_disk(key, content, expires_at)
+
+    async def compute():
+        return {"stream": False, "content": "answer"}
+
+    async def lookup(cache):
+        return await cache.aget_or_compute("ef" + "0" * 62, compute)
+
+    assert asyncio.run(lookup(RecordingCache(1024 * 1024, ttl=60, directory=str(tmp_path))))[1] == "MISS"
+    # A fresh process finds the answer on disk
+    result, status = asyncio.run(lookup(RecordingCache(1024 * 1024, ttl=60, directory=str(tmp_path))))
+    assert status == "HIT" and result["content"] == "answer"
+    assert len(disk_threads) == 3 and threading.get_ident() not in disk_threads
+
+
+def test_sweep_removes_expired_then_oldest_entries(proxy, tmp_path):
+    cache = proxy.ResponseCache(1024 * 1024, ttl=60, directory=str(tmp_path))
+    now = time.time()
+    for index, age in enumerate((120, 30, 20, 10)):
+        key = f"{index:02d}" + "0" * 62
+        cache.put(key, "x" * 100)
+        os.utime(cache._disk_path(key), (now - age, now - age))
+    # Room for exactly the two newest entries
+    cache.directory_max_bytes = sum(os.path.getsize(cache._disk_path(f"{index:02d}" + "0" * 62)) for index in (2, 3))
+    assert cache.sweep_disk() == 2
+    assert cache_files(tmp_path) == ["02" + "0" * 62 + ".json", "03" + "0" * 62 + ".json"]
+
+
+def test_key_covers_the_whole_conversation(proxy):
+    first = proxy.ResponseCache.key("gpt-4o", "endpoint", [("user", "a"), ("assistant", "b"), ("user", "c")])
+    other = proxy.ResponseCache.key("gpt-4o", "endpoint", [("user", "x"), ("assistant", "y"), ("user", "c")])
+    assert first != other
+    assert first == proxy.ResponseCache.key("GPT-4o ", "endpoint", [("user", " a"), ("assistant", "b"), ("user", "c")])
@@ -0,0 +1,103 @@
+import json
+
+
+def event(answer, event_type="fulfillment", **extra) -> bytes:
+    return b"data:" + json.dumps({"eventType": event_type, "answer": answer, **extra}).encode("utf-8") + b"\n\n"
+
+
+def chunk_contents(events):
+    """Delta contents of the OpenAI chunks among rendered SSE events."""
+    contents = []
+    for raw in events:
+        payload = raw[len(b"data: "):].strip()
+        if payload != b"[DONE]":
+            contents.extend(choice["delta"]["content"] for choice in json.loads(payload)["choices"])
+    return contents
+
+
+def test_parser_joins_lines_split_across_reads(proxy):
+    parser = proxy.UpstreamEventParser()
+    data = event("Hello") + event(" world")
+    answers = []
+    for i in range(len(data)):
+        answers.extend(parser.feed(data[i:i + 1]))
+    assert answers == [b"Hello", b" world"]
+
+
+def test_parser_accepts_crlf_and_spaced_json(proxy):
+    parser = proxy.UpstreamEventParser()
+    answers = parser.feed(b'data: {"eventType": "fulfillment", "answer": "a\\"b"}\r\n\r\ndata: [DONE]\r\n')
+    assert answers == [b'a\\"b']
+    assert parser.done
+
+
+def test_parser_ignores_other_events_and_stops_at_done(proxy):
+    parser = proxy.UpstreamEventParser()
+    answers = parser.feed(event("x", event_type="metricsLog") + b"data:[DONE]\n\n" + event("late"))
+    assert answers == []
+    assert parser.done
+    assert parser.feed(event("later")) == []
+
+
+def test_parser_skips_non_string_answers(proxy):
+    parser = proxy.UpstreamEventParser()
+    assert parser.feed(event(None) + event(123) + event(["x"])) == []
+
+
+def test_parser_reads_only_the_top_level_answer(proxy):
+    parser = proxy.UpstreamEventParser()
+    assert parser.feed(event("right", meta={"answer": "WRONG"})) == [b"right"]
+
+
+def test_parser_ignores_nested_answer_without_top_level_one(proxy):
+    parser = proxy.UpstreamEventParser()
+    assert parser.feed(b'data:{"eventType":"fulfillment","meta":{"answer":"WRONG"}}\n\n') == []
+    assert parser.feed(b'data:{"meta":{"eventType":"fulfillment"},"answer":"WRONG"}\n\n') == []
+    assert parser.feed(b'data:{"eventType":"fulfillment","note":"{","answer":"right"}\n\n') == [b"right"]
+
+
+def test_parser_finish_parses_unterminated_line(proxy):
+    parser = proxy.UpstreamEventParser()
+    assert parser.feed(event("a")[:-2]) == []
+    assert parser.finish() == [b"a"]
+
+
+def test_collect_answer_decodes_escapes(proxy):
+    assert proxy.collect_answer([event("Hi 世界\n"), event("!")]) == "Hi 世界\n!"
+
+
+def test_translator_emits_one_chunk_per_answer_then_done(proxy):
+    translator = proxy.StreamTranslator("gpt-4o", coalesce_bytes=0, coalesce_ms=0)
+    events = translator.feed(event("a") + event('"b"') + b"data:[DONE]\n\n")
+    assert chunk_contents(events) == ["a", '"b"']
+    assert events[-1] == b"data: [DONE]\n\n"
+    first = json.loads(events[0][len(b"data: "):])
+    assert first["model"] == "gpt-4o" and first["object"] == "chat.completion.chunk"
+
+
+def test_translator_coalesces_by_size(proxy):
+    translator = proxy.StreamTranslator("m", coalesce_bytes=4, coalesce_ms=60_000)
+    assert translator.feed(event("ab")) == []
+    assert chunk_contents(translator.feed(event("cd") + event("e"))) == ["abcd"]
+    assert chunk_contents(translator.finish()) == ["e"]
+
+
+def test_translator_without_time_window_flushes_each_read(proxy):
+    translator = proxy.StreamTranslator("m", coalesce_bytes=1024, coalesce_ms=0)
+    assert chunk_contents(translator.feed(event("a") + event("b"))) == ["ab"]
+    assert chunk_contents(translator.feed(event("c"))) == ["c"]
+
+
+def test_translator_flushes_pending_content_at_done(proxy):
+    translator = proxy.StreamTranslator("m", coalesce_bytes=1024, coalesce_ms=60_000)
+    events = translator.feed(event("a") + event("b") + b"data:[DONE]\n\n")
+    assert chunk_contents(events) == ["ab"]
+    assert events[-1] == b"data: [DONE]\n\n"
+
+
+def test_translator_reports_usage_when_requested(proxy):
+    translator = proxy.StreamTranslator("m", coalesce_bytes=0, coalesce_ms=0, usage_prompt_tokens=7)
+    events = translator.feed(event("abcdefgh") + b"data:[DONE]\n\n")
+    usage = json.loads(events[-2][len(b"data: "):])
+    assert usage["choices"] == []
+    assert usage["usage"] == {"prompt_tokens": 7, "completion_tokens": 2, "total_tokens": 9}
@@ -0,0 +1,171 @@
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+
+class FakeStream:
+    """Stands in for an upstream streaming response."""
+
+    def __init__(self, chunks=(), error=None):
+        self.chunks = list(chunks)
+        self.error = error
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    async def aclose(self):
+        self.closed = True
+
+    async def aiter_bytes(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+
+@pytest.fixture
+def upstream(proxy, monkeypatch):
+    """Two fake accounts whose queries return the results scripted per account in ``replies``."""
+    pool = proxy.AccountPool([{"email": "a@example.com", "password": "x"}, {"email": "b@example.com", "password": "x"}],
+                             max_per_account=4)
+    replies = {0: [], 1: []}
+    calls = []
+    session_ids = itertools.count()
+    for slot in pool.slots:
+        def send_query(query, index=slot.index, delay=0.0, **kwargs):
+            calls.append(index)
+            reply = replies[index].pop(0) if replies[index] else {"stream": False, "content": "ok", "ttfb": 0.0}
+            if callable(reply):
+                reply = reply()
+            return reply
+
+        async def async_send_query(query, index=slot.index, **kwargs):
+            return send_query(query, index)
+
+        slot.client.ensure_signed_in = lambda: True
+        slot.client.create_session = lambda index=slot.index: f"session-{index}-{next(session_ids)}"
+        slot.client.send_query = send_query
+        slot.client.async_send_query = async_send_query
+    # Lazy module globals: set them directly so that no real accounts are built
+    monkeypatch.setitem(vars(proxy), "account_pool", pool)
+    monkeypatch.setitem(vars(proxy), "admission", proxy.AdmissionController(8, capacity=pool.capacity))
+    monkeypatch.setitem(vars(proxy), "CLIENT_SESSIONS",
+                        proxy.ClientSessionStore(proxy.MemorySessionBackend(100), 600))
+    monkeypatch.setitem(vars(proxy), "_attempt_executor", ThreadPoolExecutor(max_workers=4))
+    monkeypatch.setattr(proxy, "RETRY_BACKOFF_BASE_SECONDS", 0.0)
+    monkeypatch.setattr(proxy, "RETRY_BACKOFF_MAX_SECONDS", 0.0)
+    monkeypatch.setattr(proxy, "HEDGE_AFTER_SECONDS", 0.0)
+    yield pool, replies, calls
+    proxy._attempt_executor.shutdown(wait=True)
+
+
+def chat(stream=False):
+    return {"query": "hi", "endpoint_id": "endpoint", "upstream_options": {}, "sticky_session": True,
+            "new_session": False, "model": "m", "prompt_tokens": 1, "include_usage": False, "stream": stream}
+
+
+def failure(retryable=True):
+    return {"error": "upstream failed", "retryable": retryable}
+
+
+def test_deadline_caps_only_streaming_header_waits(proxy):
+    policy = proxy.RetryPolicy(deadline=5.0)
+    timeout, expired = proxy._attempt_timeout(None, "session", True, policy)
+    assert expired is None and 0 < timeout <= 5.0
+    # A non-streaming response only starts once the whole answer is ready
+    assert proxy._attempt_timeout(None, "session", False, policy) == (None, None)
+
+
+def test_failed_attempt_fails_over_to_another_account(proxy, upstream):
+    pool, replies, calls = upstream
+    replies[0].append(failure())
+    replies[1].append(failure())
+    attempt = proxy.open_upstream(chat(), "client", stream=False)
+    assert attempt.ok
+    assert calls[:2] in ([0, 1], [1, 0]) and len(calls) == 3
+    assert proxy.CLIENT_SESSIONS.get("client").account_index == attempt.slot.index
+    pool.release(attempt.slot)
+    assert [slot.outstanding for slot in pool.slots] == [0, 0]
+
+
+def test_non_retryable_failure_is_not_retried(proxy, upstream):
+    pool, replies, calls = upstream
+    replies[0].append(failure(retryable=False))
+    replies[1].append(failure(retryable=False))
+    attempt = proxy.open_upstream(chat(), "client", stream=False)
+    assert not attempt.ok and len(calls) == 1
+    assert [slot.outstanding for slot in pool.slots] == [0, 0]
+
+
+def test_repeated_failures_open_the_circuit_breaker(proxy, upstream):
+    pool, replies, calls = upstream
+    slot = pool.slots[0]
+    for _ in range(proxy.ACCOUNT_FAILURE_THRESHOLD):
+        pool.release(pool.acquire(preferred=0), ok=False)
+    assert not slot.is_healthy(time.monotonic())
+    assert pool.capacity() == pool.max_per_account
+    assert pool.acquire(preferred=0).index == 1
+    # A cancelled lease records no outcome either way
+    pool.release(pool.slots[1], ok=None)
+    assert pool.slots[1].consecutive_failures == 0
+
+
+def test_cancelled_request_is_never_sent(proxy, upstream):
+    pool, replies, calls = upstream
+    cancellation = proxy.Cancellation()
+    cancellation.cancel()
+    attempt = proxy.open_upstream(chat(), "client", stream=False, cancellation=cancellation)
+    assert attempt.result.get("cancelled") and calls == []
+    assert [slot.outstanding for slot in pool.slots] == [0, 0]
+
+
+def test_slow_stream_is_hedged_on_another_account(proxy, upstream, monkeypatch):
+    pool, replies, calls = upstream
+    monkeypatch.setattr(proxy, "HEDGE_AFTER_SECONDS", 0.05)
+    release_primary = threading.Event()
+    primary_stream = FakeStream()
+
+    def slow():
+        release_primary.wait(5)
+        return {"stream": True, "response": primary_stream, "ttfb": 0.5}
+
+    replies[0].append(slow)
+    replies[1].append({"stream": True, "response": FakeStream(), "ttfb": 0.0})
+    proxy.CLIENT_SESSIONS.put("client", "session-sticky", 0)
+    attempt = proxy.open_upstream(chat(stream=True), "client", stream=True)
+    assert attempt.ok and attempt.slot.index == 1
+    assert proxy.admission.in_flight == 0  # the hedge's extra slot is handed back
+    release_primary.set()
+    proxy._attempt_executor.shutdown(wait=True)
+    # The losing attempt is closed and its lease returned once it completes
+    assert primary_stream.closed
+    assert pool.slots[0].outstanding == 0
+    pool.release(attempt.slot)
+
+
+def test_asgi_stream_failing_midway_counts_against_the_account(proxy, upstream):
+    pool, replies, calls = upstream
+    proxy._import_httpx()
+    stream = FakeStream([b'data:{"eventType":"fulfillment","answer":"a"}\n\n'], error=httpx.ReadError("reset"))
+    replies[0].append({"stream": True, "response": stream, "ttfb": 0.0})
+    replies[1].append({"stream": True, "response": stream, "ttfb": 0.0})
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    metrics = proxy.ChatRequestMetrics("stream")
+    status = asyncio.run(proxy._asgi_stream_chat(send, chat(stream=True), "client", metrics))
+    metrics.finish(status)
+    assert status == "error"
+    assert sent[-1] == {"type": "http.response.body", "body": b""}
+    assert stream.closed
+    assert sum(slot.consecutive_failures for slot in pool.slots) == 1
+    assert [slot.outstanding for slot in pool.slots] == [0, 0]
+    assert proxy.admission.idle
@@ -0,0 +1,60 @@
+import pytest
+
+
+def test_request_overrides_model_defaults(proxy):
+    options, error = proxy.upstream_options({"max_tokens": 64, "temperature": "0.5", "stop": "END"},
+                                            {"max_tokens": 256, "top_p": 0.9, "reasoning_effort": "low"})
+    assert error is None
+    assert options["reasoningMode"] == "low"
+    assert options["modelConfigs"] == {"maxTokens": 64, "temperature": 0.5, "topP": 0.9, "stopTokens": ["END"]}
+
+
+def test_debug_mode_is_taken_only_from_model_defaults(proxy):
+    options, error = proxy.upstream_options({"debug_mode": "on"}, {"debug_mode": "off"})
+    assert error is None and options["debugMode"] == "off"
+    options, error = proxy.upstream_options({"debug_mode": "off", "reasoning_effort": "medium"}, {"debug_mode": "on"})
+    assert error is None and options["debugMode"] == "on" and options["reasoningMode"] == "medium"
+
+
+def test_whole_float_is_accepted_as_integer(proxy):
+    options, error = proxy.upstream_options({"max_completion_tokens": 256.0}, {})
+    assert error is None and options["modelConfigs"]["maxTokens"] == 256
+
+
+@pytest.mark.parametrize("name, value", [
+    ("temperature", "nan"),
+    ("temperature", float("inf")),
+    ("temperature", 2.5),
+    ("temperature", -0.1),
+    ("temperature", True),
+    ("top_p", 1.5),
+    ("max_tokens", -1),
+    ("max_tokens", 1.5),
+    ("max_tokens", "inf"),
+    ("max_tokens", False),
+    ("presence_penalty", 3),
+    ("frequency_penalty", [1]),
+    ("stop", 5),
+    ("reasoning_effort", "extreme"),
+    ("reasoning_effort", 1),
+])
+def test_invalid_values_are_rejected(proxy, name, value):
+    options, (body, status) = proxy.upstream_options({name: value}, {})
+    assert options is None
+    assert status == 400 and name in body["error"]
+
+
+@pytest.mark.parametrize("data", [
+    {"messages": ["hi"]},
+    {"messages": {"role": "user", "content": "hi"}},
+    {"messages": [{"role": 1, "content": "hi"}]},
+    {"messages": [{"role": "user", "content": "hi"}], "model": ["gpt-4o"]},
+    {"messages": [{"role": "user", "content": "hi"}], "stream": True, "stream_options": "include_usage"},
+])
+def test_malformed_chat_request_is_rejected(proxy, data):
+    chat, (body, status) = proxy.parse_chat_request(data)
+    assert chat is None and status == 400
+
+
+def test_non_text_content_parts_are_ignored(proxy):
+    assert proxy.message_text([{"type": "text", "text": "a"}, {"type": "text", "text": 5}, "b"]) == "a"